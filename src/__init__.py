@@ -43,6 +43,26 @@ class _MyAPI(BundleAPI):
             return tool.XMAS(session, ti.name)
         raise ValueError("trying to start unknown tool: %s" % ti.name)
 
+    @staticmethod
+    def register_command(bi, ci, logger):
+        # bi is an instance of chimerax.core.toolshed.BundleInfo
+        # ci is an instance of chimerax.core.toolshed.CommandInfo
+        # logger is an instance of chimerax.core.logger.Logger
+
+        # This method is called once for each command listed in
+        # pyproject.toml. The command function and its description are
+        # taken from the ``cmd`` module.
+        from chimerax.core.commands import register
+        from . import cmd
+        if ci.name == "xmas clearcache":
+            register(ci.name, cmd.clearcache_desc, cmd.clearcache, 
+                     logger=logger)
+            return
+        if ci.name == "xmas settings":
+            register(ci.name, cmd.settings_desc, cmd.settings, logger=logger)
+            return
+        raise ValueError("trying to register unknown command: %s" % ci.name)
+
     @staticmethod
     def get_class(class_name):
         # class_name will be a string
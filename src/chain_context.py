@@ -0,0 +1,243 @@
+# Copyright 2022 Scheltema LAB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from chimerax.atomic import Atoms, get_triggers
+from chimerax.core.models import MODEL_ID_CHANGED, REMOVE_MODELS
+from hashlib import blake2b
+import numpy as np
+
+# Residue and atom changes that affect the numbering of a chain or its CA
+# atoms. Other changes (e.g. coordinates, colors) leave a context valid
+residue_reasons = {"number changed", "insertion_code changed", "name changed"}
+atom_reasons = {"name changed"}
+
+
+class ChainContext:
+
+    # Everything about a chain that is needed to align peptides to it and to
+    # connect the alignments to atoms
+
+
+    def __init__(self, chain):
+
+        self.chain_id = chain.chain_id
+        self.sequence = chain.characters
+        # Chains with identical sequences share alignments, so alignments are
+        # stored with a hash of the sequence
+        self.sequence_key = blake2b(self.sequence.encode(),
+                                    digest_size=16).digest()
+
+        # The index of a residue on the sequence string differs from its
+        # "number" attribute. Store the number of the first residue, taking
+        # into account the NoneType (missing) residues at the start of the
+        # sequence, so that it can be added to indices on the sequence string.
+        # Pseudobonds cannot be created between missing residues, so their
+        # positions are stored as well
+        self.first_residue_number = None
+        self.missing_positions = set()
+        # Residues that are present but lack a CA atom cannot be crosslinked
+        # either
+        self.no_ca_positions = set()
+        # The CA atoms of the chain, and for each sequence position the index
+        # of its CA atom (-1 if there is none)
+        ca_atoms = []
+        self.ca_index = np.full(len(self.sequence), -1, dtype=np.int32)
+        no_ca_numbers = []
+        preceding_nonetypes = 0
+
+        for i, residue in enumerate(chain.residues):
+            if residue is None:
+                self.missing_positions.add(i)
+                if self.first_residue_number is None:
+                    preceding_nonetypes += 1
+                continue
+            if self.first_residue_number is None:
+                self.first_residue_number = (residue.number
+                                             - preceding_nonetypes)
+            atom = residue.find_atom("CA")
+            if atom is None:
+                self.no_ca_positions.add(i)
+                no_ca_numbers.append(str(residue.number))
+                continue
+            self.ca_index[i] = len(ca_atoms)
+            ca_atoms.append(atom)
+
+        self.ca_atoms = Atoms(ca_atoms)
+
+        if len(no_ca_numbers) > 0:
+            print("Residues without CA atom in #%s/%s are disregarded: %s"
+                  % (chain.structure.id_string, self.chain_id,
+                     ", ".join(no_ca_numbers)))
+
+
+    def has_ca(self, position):
+
+        # Check whether the residue at a sequence position is present in the
+        # structure and has a CA atom
+
+        return self.ca_index[position] >= 0
+
+
+    def ca_atom(self, position):
+
+        # Return the CA atom of the residue at a sequence position
+
+        return self.ca_atoms[self.ca_index[position]]
+
+
+class ChainContextCache:
+
+    # Stores a ChainContext per chain per structure, so that mapping multiple
+    # evidence files to the same models sets up each chain only once. The
+    # command line spec strings of atoms, used for lines in .pb files, are
+    # stored per structure as well. Contexts and strings of a structure are
+    # discarded when its residues or atoms are added, deleted, renumbered or
+    # renamed, or when the structure is closed. Strings are also discarded
+    # when the model id of the structure changes
+
+
+    def __init__(self, session):
+
+        self.contexts = {}
+        self.atom_strings = {}
+
+        self.triggerset = session.triggers
+        self.changes_handler = get_triggers().add_handler(
+            "changes", self.changes_handler_function
+            )
+        self.remove_model_handler = self.triggerset.add_handler(
+            REMOVE_MODELS, self.remove_models_function
+            )
+        self.model_id_handler = self.triggerset.add_handler(
+            MODEL_ID_CHANGED, self.model_id_changed_function
+            )
+
+
+    def get(self, structure, chain):
+
+        # Return the context of a chain, creating it if necessary
+
+        if structure not in self.contexts:
+            self.contexts[structure] = {}
+        chain_contexts = self.contexts[structure]
+        chain_id = chain.chain_id
+
+        if chain_id not in chain_contexts:
+            chain_contexts[chain_id] = ChainContext(chain)
+
+        return chain_contexts[chain_id]
+
+
+    def get_atom_strings(self, atoms):
+
+        # Return an array with the command line spec string of each atom in
+        # an Atoms collection. Strings that are not stored yet are created 
+        # for all atoms of a structure that lack one at once
+
+        strings = np.empty(len(atoms), dtype=object)
+
+        for structure, indices in self.structure_indices(atoms):
+            if structure not in self.atom_strings:
+                self.atom_strings[structure] = {}
+            structure_strings = self.atom_strings[structure]
+            structure_atoms = atoms[indices]
+            for atom in structure_atoms:
+                if atom not in structure_strings:
+                    structure_strings[atom] = atom.string(
+                        style="command line", omit_structure=False)
+            strings[indices] = [structure_strings[atom] 
+                                for atom in structure_atoms]
+
+        return strings.astype(str)
+
+
+    @staticmethod
+    def structure_indices(atoms):
+
+        # Return the structures of an Atoms collection, each with the indices
+        # of its atoms
+
+        structures = atoms.structures
+        pointers = structures.pointers
+        unique_pointers, inverse = np.unique(pointers, return_inverse=True)
+        first = [np.flatnonzero(pointers == pointer)[0] 
+                 for pointer in unique_pointers]
+
+        return [(structures[i], np.flatnonzero(inverse == j))
+                for j, i in enumerate(first)]
+
+
+    def invalidate(self, structures=None):
+
+        # Discard the contexts and atom strings of the given structures, or 
+        # of all structures when none are given
+
+        if structures is None:
+            self.contexts.clear()
+            self.atom_strings.clear()
+            return
+
+        for structure in structures:
+            self.contexts.pop(structure, None)
+            self.atom_strings.pop(structure, None)
+
+
+    def changes_handler_function(self, trigger, changes):
+
+        # Called when atomic data in the session has changed
+
+        if not self.contexts and not self.atom_strings:
+            return
+
+        # It is unknown to which structures deleted items belonged
+        if (changes.num_deleted_atoms() > 0
+                or changes.num_deleted_residues() > 0
+                or changes.num_deleted_chains() > 0):
+            self.invalidate()
+            return
+
+        structures = set()
+        structures.update(changes.created_residues().unique_structures)
+        structures.update(changes.created_atoms().unique_structures)
+        structures.update(chain.structure
+                          for chain in changes.modified_chains())
+        if residue_reasons.intersection(changes.residue_reasons()):
+            structures.update(changes.modified_residues().unique_structures)
+        if atom_reasons.intersection(changes.atom_reasons()):
+            structures.update(changes.modified_atoms().unique_structures)
+
+        self.invalidate(structures)
+
+
+    def remove_models_function(self, trigger, models):
+
+        # Called when models are closed
+
+        self.invalidate(models)
+
+
+    def model_id_changed_function(self, trigger, model):
+
+        # Called when the id of a model changes. Atom strings contain the
+        # model id, while chain contexts do not
+
+        self.atom_strings.pop(model, None)
+
+
+    def remove_handlers(self):
+
+        get_triggers().remove_handler(self.changes_handler)
+        self.triggerset.remove_handler(self.remove_model_handler)
+        self.triggerset.remove_handler(self.model_id_handler)
@@ -0,0 +1,103 @@
+# Copyright 2022 Scheltema LAB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from .parse_cache import get_parse_cache
+from .settings import _XMASSettings, get_settings
+from chimerax.core.commands import CmdDesc, EnumOf, StringArg
+from chimerax.core.errors import UserError
+
+
+def clearcache(session):
+    
+    # Remove all parsed evidence files from the parse cache, so that evidence
+    # files are parsed again when they are mapped
+    
+    number_of_files = get_parse_cache(session).clear()
+    session.logger.info("Removed %s parsed evidence file(s) from the cache" 
+                        % number_of_files)
+    
+    
+clearcache_desc = CmdDesc(
+    synopsis="Remove parsed evidence files from the XMAS cache"
+    )
+
+
+def settings(session, name=None, value=None):
+    
+    # Show the XMAS settings, or change one of them. Values are converted to
+    # the type of the default value of the setting. Settings are saved 
+    # between sessions
+    
+    xmas_settings = get_settings(session)
+    
+    if name is None:
+        lines = ["%s: %s" % (setting, getattr(xmas_settings, setting))
+                 for setting in xmas_settings.AUTO_SAVE]
+        session.logger.info("XMAS settings:<br>" + "<br>".join(lines),
+                            is_html=True)
+        return
+    
+    if value is None:
+        session.logger.info("%s: %s" % (name, getattr(xmas_settings, name)))
+        return
+    
+    setattr(xmas_settings, name, convert_setting(name, value))
+    session.logger.info("%s is set to %s" 
+                        % (name, getattr(xmas_settings, name)))
+
+
+def convert_setting(name, value):
+    
+    # Convert the string value of a setting to the type of its default value.
+    # Settings with None as default are numbers that can be "none"
+    
+    default = _XMASSettings.AUTO_SAVE[name]
+    
+    if isinstance(default, bool):
+        if value.lower() in ("true", "1", "on"):
+            return True
+        if value.lower() in ("false", "0", "off"):
+            return False
+        raise UserError("%s must be true or false" % name)
+    
+    if default is None and value.lower() == "none":
+        return None
+    
+    try:
+        if isinstance(default, int):
+            converted = int(value)
+        else:
+            converted = float(value)
+    except ValueError:
+        raise UserError("%s must be a number" % name)
+    
+    if converted < minimum_values.get(name, 0):
+        raise UserError("%s must be at least %s" 
+                        % (name, minimum_values.get(name, 0)))
+        
+    return converted
+
+
+# Minimum values of numeric settings other than 0
+minimum_values = {"alignment_workers": 1, "evidence_chunk_size": 1,
+                  "evidence_workers": 1, 
+                  "evidence_minimum_score": float("-inf")}
+
+    
+settings_desc = CmdDesc(
+    optional=[("name", EnumOf(list(_XMASSettings.AUTO_SAVE))),
+              ("value", StringArg)],
+    synopsis="Show or change the XMAS settings"
+    )
@@ -13,6 +13,8 @@
 # limitations under the License.
 
 
+import numpy as np
+import os
 import pandas as pd
 from Qt.QtWidgets import QMessageBox
 
@@ -23,35 +25,93 @@ ref_columns = {"XlinkX": "Row in evidence file",
               "Xi": "PeptidePairID",
               "Xi_alternative": "PSMID",
               "mzIdentML": "Peptide id"}
+# Columns that are stored as categories and as numbers in the columnar 
+# companion file
+categorical_columns = ["Pseudobond", "Overlap category"]
+numeric_columns = ["Distance (A)", "Mismatches"]
 
 
 # Each mapping information file is created and maintainted with an instance if 
 # this class.
 class InfoFile:
     
+    # Distance updates are appended to a delta file next to the mapping
+    # information file. The file is rewritten completely (compacted) when the
+    # delta file contains more rows than this fraction of the rows
+    compaction_fraction = 0.1
     
-    def __init__(self, path, engine):
-        # Create a dataframe for the evidence file
+    
+    def __init__(self, path, engine, mismatches=False, companion=False):
+        # Create a dataframe for the evidence file. With approximate 
+        # alignment, the number of mismatches of the peptide pair alignments 
+        # is added in an extra column. With "companion", a columnar npz file
+        # is written next to the tsv file
         self.ref_column = ref_columns[engine]
         self.columns = [self.ref_column, "Pseudobond", "Overlap category", 
                         "Distance (A)"]
-        self.df = pd.DataFrame(columns=self.columns)
+        self.mismatches = mismatches
+        if mismatches:
+            self.columns.append("Mismatches")
+        self._df = pd.DataFrame(columns=self.columns)
+        # Rows are first added to a buffer with a list per column, and only
+        # added to the dataframe when it is needed
+        self.buffer = [[] for column in self.columns]
+        self.number_of_rows = 0
         self.path = path
+        self.delta_path = delta_path(path)
+        self.number_of_delta_rows = 0
+        self.companion = companion
+    
+    
+    def add(self, row_number, value, category="", distance="", 
+            mismatches=""):
+        # Add a row to the buffer and return its index in the dataframe
+        values = [row_number, value, category, distance]
+        if self.mismatches:
+            values.append(mismatches)
+        for i, column in enumerate(self.buffer):
+            column.append(values[i])
+        self.number_of_rows += 1
+        
+        return self.number_of_rows - 1
     
     
-    def add(self, row_number, value, category="", distance=""):
-        # Add a row to the dataframe
-        data = [[row_number, value, category, distance]]
-        df_add = pd.DataFrame(data, columns=self.columns)
-        self.df = pd.concat([self.df, df_add], ignore_index=True)
+    def add_rows(self, row_numbers, value):
+        # Add a row with the same value for each row number to the buffer
+        number_of_rows = len(row_numbers)
+        self.buffer[0].extend(row_numbers)
+        self.buffer[1].extend([value] * number_of_rows)
+        for column in self.buffer[2:]:
+            column.extend([""] * number_of_rows)
+        self.number_of_rows += number_of_rows
+    
+    
+    @property
+    def df(self):
+        # Return the dataframe, after adding the rows in the buffer to it. The
+        # index of a row is the value returned by "add"
+        buffered = len(self.buffer[0])
+        if buffered == 0:
+            return self._df
         
-        return len(self.df.index) - 1
+        start = self.number_of_rows - buffered
+        df_add = pd.DataFrame(dict(zip(self.columns, self.buffer)), 
+                              columns=self.columns, 
+                              index=range(start, self.number_of_rows))
+        if len(self._df.index) == 0:
+            self._df = df_add
+        else:
+            self._df = pd.concat([self._df, df_add])
+        self.buffer = [[] for column in self.columns]
+        
+        return self._df
         
     
     def create_file(self):
         # Create the tsv file from the dataframe. First sort the dataframe on
         # the reference column
-        self.df.sort_values([self.ref_column, "Pseudobond"], inplace=True)
+        df = self.df
+        df.sort_values([self.ref_column, "Pseudobond"], inplace=True)
         
         # Before creating the file, check whether it is not open already, to
         # prevent permission error
@@ -70,4 +130,123 @@ class InfoFile:
                 msg.setWindowTitle("Error")
                 msg.exec_()
                 
-        self.df.to_csv(self.path, sep="\t", index=False)
\ No newline at end of file
+        df.to_csv(self.path, sep="\t", index=False)
+        # A companion file of an earlier run is removed, so that it is not
+        # loaded instead of the tsv file
+        if self.companion:
+            write_companion(self.path, df)
+        elif os.path.exists(companion_path(self.path)):
+            os.remove(companion_path(self.path))
+        
+        # The file contains all updates now
+        if os.path.exists(self.delta_path):
+            os.remove(self.delta_path)
+        self.number_of_delta_rows = 0
+        
+        
+    def update_distances(self, distances):
+        # Update the distances of the rows given by index in a dictionary, 
+        # and append the changed rows to the delta file, keyed by reference 
+        # and pseudobond. The file is compacted when the delta file has become
+        # too large. Return the number of changed rows
+        df = self.df
+        changed = [index for index, distance in distances.items() 
+                   if df.at[index, "Distance (A)"] != distance]
+        if len(changed) == 0:
+            return 0
+        
+        for index in changed:
+            df.at[index, "Distance (A)"] = distances[index]
+        
+        rows = df.loc[changed, [self.ref_column, "Pseudobond", 
+                                "Distance (A)"]]
+        rows.to_csv(self.delta_path, sep="\t", index=False, mode="a",
+                    header=not os.path.exists(self.delta_path))
+        self.number_of_delta_rows += len(changed)
+        
+        if (self.number_of_delta_rows 
+                > self.compaction_fraction * len(df.index)):
+            self.create_file()
+            
+        return len(changed)
+        
+        
+def delta_path(path):
+    # Return the path of the delta file of a mapping information file
+    return os.path.splitext(path)[0] + ".delta.tsv"
+
+
+def companion_path(path):
+    # Return the path of the columnar companion file of a mapping 
+    # information file
+    return os.path.splitext(path)[0] + ".npz"
+
+
+def write_companion(path, df):
+    # Write the columns of a mapping information file to an uncompressed npz
+    # file. "Overlap category" and "Pseudobond" are stored as categories with
+    # an array of integer codes, numeric columns as float64 with NaN for 
+    # empty values, and other columns as strings
+    arrays = {"columns": np.array(df.columns, dtype=str)}
+    for i, col_name in enumerate(df.columns):
+        series = df[col_name]
+        if col_name in categorical_columns:
+            categorical = pd.Categorical(series.astype(str))
+            arrays["codes_%s" % i] = categorical.codes
+            arrays["categories_%s" % i] = np.array(categorical.categories, 
+                                                   dtype=str)
+        elif col_name in numeric_columns:
+            arrays["column_%s" % i] = pd.to_numeric(
+                series.replace("", np.nan)).values.astype(np.float64)
+        elif series.dtype.kind in "iu":
+            arrays["column_%s" % i] = series.values
+        else:
+            arrays["column_%s" % i] = series.values.astype(str)
+    
+    np.savez(companion_path(path), **arrays)
+    
+    
+def load_info_file(path):
+    # Load a mapping information file from its columnar companion file, with
+    # "Overlap category" and "Pseudobond" as categorical columns, and apply 
+    # the distance updates in its delta file. The tsv file is read if there
+    # is no companion file, or if the tsv file has been written after it
+    if (not os.path.exists(companion_path(path))
+            or os.path.getmtime(companion_path(path)) 
+            < os.path.getmtime(path)):
+        return read_info_file(path)
+    
+    with np.load(companion_path(path), allow_pickle=False) as npz:
+        columns = {}
+        for i, col_name in enumerate(npz["columns"].tolist()):
+            if "codes_%s" % i in npz.files:
+                columns[col_name] = pd.Categorical.from_codes(
+                    npz["codes_%s" % i], npz["categories_%s" % i])
+            else:
+                columns[col_name] = npz["column_%s" % i]
+    
+    return apply_delta(pd.DataFrame(columns), path)
+
+
+def read_info_file(path):
+    # Read a mapping information file into a dataframe, and apply the
+    # distance updates in its delta file
+    return apply_delta(pd.read_csv(path, sep="\t"), path)
+
+
+def apply_delta(df, path):
+    # Apply the distance updates in the delta file of a mapping information
+    # file. Rows are identified by their reference and pseudobond, and the 
+    # last update of a row is applied
+    if not os.path.exists(delta_path(path)):
+        return df
+    
+    keys = list(df.columns[:2])
+    delta = pd.read_csv(delta_path(path), sep="\t")
+    delta = delta.drop_duplicates(keys, keep="last").set_index(keys)
+    updates = delta["Distance (A)"].reindex(pd.MultiIndex.from_arrays(
+        [df[key].astype(object) for key in keys])).values
+    df["Distance (A)"] = np.where(pd.notna(updates), updates, 
+                                  df["Distance (A)"].values)
+    
+    return df
\ No newline at end of file
@@ -14,15 +14,17 @@
 
 
 from .read_evidence import PeptidePair
-import re
-import xml.dom.minidom as minidom
+import xml.etree.ElementTree as ElementTree
 
 
 class XlPeptide(PeptidePair):
     
+    __slots__ = ["Id"]
+    
     def __init__(self):
 
         super().__init__()
+        self.Id = ""
         
     
     @staticmethod
@@ -88,56 +90,62 @@ class XlSpectrumIdentification:
         self.SpectraCount = 1
         
 
+def local_name(tag):
+    
+    # Element tags include the mzIdentML namespace; return the tag without it
+    
+    return tag.rsplit("}", 1)[-1]
+
+
+def find_all(element, name):
+    
+    # Return all descendants of an element with the given tag
+    
+    return [descendant for descendant in element.iter() 
+            if local_name(descendant.tag) == name and descendant != element]
+
+
 # For some reason mzIdentML uses their unique sequence id insead of input 
 # accession id
-# This function returns dictionary with ID as key, from which we can find 
+# This function returns the DBSequence for an element, from which we can find 
 # protein accession and description if needed
-def parse_sequence_dbs(mzidentfile):
-    doc = minidom.parse(mzidentfile)
-    db_sequences = {}
-    protein_sequence_data = doc.getElementsByTagName("DBSequence")
-    for sequence in protein_sequence_data:
-        sq = DBSequence()
-        sq.Accession = sequence.getAttribute("accession")
-        sq.Id = sequence.getAttribute("id")
-        cv_param = sequence.getElementsByTagName("cvParam")
-        try:
-            sq.ProteinDescription = cv_param[0].getAttribute("value")
-        except: pass
-        db_sequences[sq.Id] = sq
-    return db_sequences
+def parse_sequence_db(sequence):
+    sq = DBSequence()
+    sq.Accession = sequence.get("accession", "")
+    sq.Id = sequence.get("id", "")
+    cv_param = find_all(sequence, "cvParam")
+    try:
+        sq.ProteinDescription = cv_param[0].get("value", "")
+    except: pass
+    return sq
 
 
 # Only real purpose to read this data blob is to find to which protein the 
 # peptide belongs and its location in sequence
-def parse_xl_peptides_evidence(mzidentfile):
-    doc = minidom.parse(mzidentfile)
-    evidences = {}
-    peptide_evidence = doc.getElementsByTagName("PeptideEvidence")
-    for evidence in peptide_evidence:
-        ev = XlPeptideEvidence()
-        ev.DBSequenceRef  = evidence.getAttribute("dBSequence_ref")
-        ev.Id = evidence.getAttribute("id")
-        ev.PeptideRef= evidence.getAttribute("peptide_ref")
-        ev.Start = evidence.getAttribute("start")
-        ev.End = evidence.getAttribute("end")
-        evidences[ev.PeptideRef] = ev
-    return evidences
+def parse_xl_peptide_evidence(evidence):
+    ev = XlPeptideEvidence()
+    ev.DBSequenceRef  = evidence.get("dBSequence_ref", "")
+    ev.Id = evidence.get("id", "")
+    ev.PeptideRef= evidence.get("peptide_ref", "")
+    ev.Start = evidence.get("start", "")
+    ev.End = evidence.get("end", "")
+    return ev
 
 
 # Store the best crosslink score and CSM count from spectra hits
 # Track DON and RCV peptide information
-def parse_spectrum_identification_result(mzidentfile):
+def parse_spectrum_identification_result(spectramatch, best_spectra_match,
+                                         don_rcv_peptide_refs):
 
     # Helper function to extract info for both x-link peptides. DON has index 0 
     # and RCV index 1.
     def extract_info (specindex, best_spectra_match):
         xlspecid = XlSpectrumIdentification()
-        xlspecid.PeptideRef = spec_id[specindex].getAttribute("peptide_ref")
-        cvparam = spec_id[specindex].getElementsByTagName("cvParam")
+        xlspecid.PeptideRef = spec_id[specindex].get("peptide_ref", "")
+        cvparam = find_all(spec_id[specindex], "cvParam")
         for cv in cvparam:
-            if ("score" in cv.getAttribute("name").lower()):
-                xlspecid.Score = cv.getAttribute("value")
+            if ("score" in cv.get("name", "").lower()):
+                xlspecid.Score = cv.get("value", "")
                 
                 if xlspecid.PeptideRef in best_spectra_match:
                     if (xlspecid.Score > best_spectra_match[xlspecid.PeptideRef].Score):
@@ -147,101 +155,135 @@ def parse_spectrum_identification_result(mzidentfile):
                     best_spectra_match[xlspecid.PeptideRef] = xlspecid
         return best_spectra_match
 
-    doc = minidom.parse(mzidentfile)
-    best_spectra_match = {}
-    don_rcv_peptide_refs = {}
-    spectra_matched = doc.getElementsByTagName("SpectrumIdentificationResult")
-    for spectramatch in spectra_matched:
-        spec_id = spectramatch.getElementsByTagName("SpectrumIdentificationItem")
-        
-        pep_ref = spec_id[0].getAttribute("peptide_ref")
-        extract_info (0, best_spectra_match)
-        if (len(spec_id) > 1):
-            extract_info (1, best_spectra_match)
-            don_rcv_peptide_refs[pep_ref] = spec_id[1].getAttribute("peptide_ref")
-
-    return best_spectra_match, don_rcv_peptide_refs
+    spec_id = find_all(spectramatch, "SpectrumIdentificationItem")
+    
+    pep_ref = spec_id[0].get("peptide_ref", "")
+    extract_info (0, best_spectra_match)
+    if (len(spec_id) > 1):
+        extract_info (1, best_spectra_match)
+        don_rcv_peptide_refs[pep_ref] = spec_id[1].get("peptide_ref", "")
 
 
-def parse_xl_peptides(mzidentfile):
-    doc = minidom.parse(mzidentfile)
+# Check peptide modifications, check if x-link MOD is present, and if peptide 
+# is RCV or DON. Return None for peptides that are neither
+def parse_peptide(peptide):
+    #Format: Mod name [location]
+    modifications = []
+    xlinkposition = int()
+    rcv_peptide = False
+    don_peptide = False
 
-    dbs = parse_sequence_dbs(mzidentfile)
-    evidences = parse_xl_peptides_evidence(mzidentfile)
+    pepmods = find_all(peptide, "Modification")
+    for mod in pepmods:
+        loc = mod.get("location", "")
+        cvparams = find_all(mod, "cvParam")
+        name = cvparams[0].get("name", "")
+        modifications.append("".join((name," [", loc, "]")))
+        for cvind in  range(0, len(cvparams), 1):
+            value = cvparams[cvind].get("accession", "")
+            if (cvparams[cvind].get("cvRef", "") == "XLMOD"):
+                xlinkposition = int(loc)
+            # X-link receiver in SIM-XL mzid
+            if (cvparams[cvind].get("name", "") == "cross-link receiver"):
+                xlinkposition = int(loc)
+            if (value == "MS:1002510"):
+                rcv_peptide = True
+            if (value == "MS:1002509"):
+                don_peptide = True
+                
+    if not (rcv_peptide or don_peptide):
+        return None
+    
+    peptidesequence = find_all(peptide, "PeptideSequence")[0].text
+    
+    return (peptidesequence, modifications, xlinkposition, don_peptide, 
+            rcv_peptide)
 
-    peptides = doc.getElementsByTagName("Peptide")
 
-    spectra_scores, don_rcv_peptide_refs = parse_spectrum_identification_result(mzidentfile)
+def parse_xl_peptides(mzidentfile):
+    
+    # The file is read in a single pass with iterparse. Each DBSequence, 
+    # Peptide, PeptideEvidence and SpectrumIdentificationResult element is 
+    # parsed when it has been read completely, after which it is removed, so 
+    # that memory use is bounded by the parsed data
+    
+    dbs = {}
+    evidences = {}
+    xl_peptides = {}
+    spectra_scores = {}
+    don_rcv_peptide_refs = {}
+    
+    # Elements whose ancestors are being read
+    ancestors = []
+    
+    for event, element in ElementTree.iterparse(mzidentfile, 
+                                                events=("start", "end")):
+        if event == "start":
+            ancestors.append(element)
+            continue
+        ancestors.pop()
+        
+        name = local_name(element.tag)
+        if name == "DBSequence":
+            sq = parse_sequence_db(element)
+            dbs[sq.Id] = sq
+        elif name == "PeptideEvidence":
+            ev = parse_xl_peptide_evidence(element)
+            evidences[ev.PeptideRef] = ev
+        elif name == "Peptide":
+            xl_peptide = parse_peptide(element)
+            if xl_peptide is not None:
+                xl_peptides[element.get("id", "")] = xl_peptide
+        elif name == "SpectrumIdentificationResult":
+            parse_spectrum_identification_result(element, spectra_scores, 
+                                                 don_rcv_peptide_refs)
+        else:
+            continue
+        
+        element.clear()
+        if len(ancestors) > 0:
+            ancestors[-1].remove(element)
 
     don_peptides = {}
     rcv_peptides = {}
 
-    for peptide in peptides:
-
-        pep_id = peptide.getAttribute("id")
-        #Check peptide modifications, check if x-link MOD is present, and if peptide is RCV or DON
-        #Format: Mod name [location]
-        modifications = []
-        xlinkposition = int()
-        rcv_peptide = False
-        don_peptide = False
-
-        pepmods = peptide.getElementsByTagName("Modification")
-        for mod in pepmods:
-            loc = mod.getAttribute("location")
-            cvparams = mod.getElementsByTagName("cvParam")
-            name = cvparams[0].getAttribute("name")
-            modifications.append("".join((name," [", loc, "]")))
-            for cvind in  range(0, len(cvparams), 1):
-                value = cvparams[cvind].getAttribute("accession")
-                if (cvparams[cvind].getAttribute("cvRef") == "XLMOD"):
-                    xlinkposition = int(loc)
-                # X-link receiver in SIM-XL mzid
-                if (cvparams[cvind].getAttribute("name") == "cross-link receiver"):
-                    xlinkposition = int(loc)
-                if (value == "MS:1002510"):
-                    rcv_peptide = True
-                if (value == "MS:1002509"):
-                    don_peptide = True
- 
-        if (rcv_peptide or don_peptide):
-            pep = XlPeptide()
+    for key in xl_peptides:
+        (peptidesequence, modifications, xlinkposition, don_peptide, 
+         rcv_peptide) = xl_peptides[key]
+        pep = XlPeptide()
             
-            key = peptide.getAttribute("id")
-            peptidesequence = peptide.getElementsByTagName("PeptideSequence")[0].firstChild.nodeValue
-            
-            if (key in evidences):
-                evidence = evidences[key]
-                accessions = dbs[evidence.DBSequenceRef].Accession
-                position = evidence.Start
-                proteindescription = dbs[evidence.DBSequenceRef].ProteinDescription
-            else:
-                accessions = ""
-                position = ""
-                proteindescription = ""
-            
-            if (key in spectra_scores):
-                pep.Score = float(spectra_scores[key].Score)
-                pep.NumCSMs = int(spectra_scores[key].SpectraCount)
-
-            if (don_peptide):
-                pep.Ref = key
-                pep.AccessionA = accessions
-                pep.ModificationsA = ";".join(modifications)
-                pep.PositionA = position
-                pep.ProteinDescriptionsA = proteindescription
-                pep.SequenceA = peptidesequence
-                pep.XLinkPositionA = xlinkposition - 1
-                don_peptides[key] = pep
-            elif (rcv_peptide):
-                pep.Ref = key
-                pep.AccessionB = accessions
-                pep.ModificationsB = ";".join(modifications)
-                pep.PositionB = position
-                pep.ProteinDescriptionsB = proteindescription
-                pep.SequenceB = peptidesequence
-                pep.XLinkPositionB = xlinkposition - 1
-                rcv_peptides[key] = pep
+        if (key in evidences):
+            evidence = evidences[key]
+            accessions = dbs[evidence.DBSequenceRef].Accession
+            position = evidence.Start
+            proteindescription = dbs[evidence.DBSequenceRef].ProteinDescription
+        else:
+            accessions = ""
+            position = ""
+            proteindescription = ""
+        
+        if (key in spectra_scores):
+            pep.Score = float(spectra_scores[key].Score)
+            pep.NumCSMs = int(spectra_scores[key].SpectraCount)
+
+        if (don_peptide):
+            pep.Ref = key
+            pep.AccessionA = accessions
+            pep.ModificationsA = ";".join(modifications)
+            pep.PositionA = position
+            pep.ProteinDescriptionsA = proteindescription
+            pep.SequenceA = peptidesequence
+            pep.XLinkPositionA = xlinkposition - 1
+            don_peptides[key] = pep
+        elif (rcv_peptide):
+            pep.Ref = key
+            pep.AccessionB = accessions
+            pep.ModificationsB = ";".join(modifications)
+            pep.PositionB = position
+            pep.ProteinDescriptionsB = proteindescription
+            pep.SequenceB = peptidesequence
+            pep.XLinkPositionB = xlinkposition - 1
+            rcv_peptides[key] = pep
 
     xlinks = []
 
@@ -250,4 +292,4 @@ def parse_xl_peptides(mzidentfile):
                                                          rcv_peptides[don_rcv_peptide_refs[key]], 
                                                          key))
        
-    return xlinks
\ No newline at end of file
+    return xlinks
@@ -0,0 +1,442 @@
+# Copyright 2022 Scheltema LAB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from .read_evidence import evidence_attributes, PeptidePair
+from .settings import get_settings
+from hashlib import blake2b
+import numpy as np
+import os
+import pandas as pd
+import tempfile
+
+# Version of the layout of cache files. Files with another version are
+# disregarded
+cache_version = 2
+# Attributes of peptide pairs that are stored in the cache. Alignments are
+# created during mapping and are not part of the parsed evidence
+cached_attributes = evidence_attributes
+# Types of non-string values that can be stored in a column
+column_types = {bool: bool, int: np.int64, float: np.float64}
+
+
+class ParseCache:
+
+    # Stores the peptide pairs parsed from evidence files in the user cache
+    # directory, so that evidence files that are mapped again, also in later
+    # sessions, need not be parsed. Each evidence file is stored in its own
+    # compressed npz file with one array per peptide pair attribute. Files
+    # are identified by the path, size and modification time of the evidence
+    # file, and optionally by a hash of its contents. For Excel evidence 
+    # files, the used columns of the sheet are stored as well, so that 
+    # openpyxl is not needed when the peptide pairs are not in the cache. 
+    # When the total size of the cache exceeds its maximum, the least 
+    # recently used files are removed. Messages are passed to the "log"
+    # function, so that files can be cached in worker threads
+
+
+    def __init__(self, directory, max_size, content_hash=False):
+
+        self.directory = directory
+        self.max_size = max_size
+        self.content_hash = content_hash
+
+
+    def path(self, evidence_file, extension=".npz", options=""):
+
+        # Return the path of a cache file of an evidence file. The options 
+        # are the settings that affect the contents of the cache file
+
+        status = os.stat(evidence_file)
+        fingerprint = blake2b(digest_size=20)
+        fingerprint.update(os.path.abspath(evidence_file).encode())
+        fingerprint.update(b"\0%d\0%d" % (status.st_size, status.st_mtime_ns))
+        fingerprint.update(b"\0" + options.encode())
+
+        if self.content_hash:
+            with open(evidence_file, "rb") as f:
+                for block in iter(lambda: f.read(2**20), b""):
+                    fingerprint.update(block)
+
+        return os.path.join(self.directory,
+                            fingerprint.hexdigest() + extension)
+
+
+    def load(self, evidence_file, options="", log=print):
+
+        # Return the cached evidence of an evidence file, or None if the file
+        # is not in the cache
+
+        data = self.read(evidence_file, ".npz", options, log)
+        if data is None:
+            return None
+
+        return CachedEvidence(str(data["engine"]), data)
+
+
+    def load_sheet(self, evidence_file, log=print):
+
+        # Return the search engine and the dataframe with the used columns 
+        # of an Excel evidence file, or None if the sheet is not in the cache
+
+        data = self.read(evidence_file, ".sheet.npz", log=log)
+        if data is None:
+            return None
+
+        df = pd.DataFrame({
+            str(col_name): decode_sheet_column(data, i)
+            for i, col_name in enumerate(data["col_names"].tolist())
+            })
+
+        return str(data["engine"]), df
+
+
+    def read(self, evidence_file, extension, options="", log=print):
+
+        # Return a dictionary with the arrays of a cache file, or None if the 
+        # file is not in the cache or cannot be read
+
+        try:
+            path = self.path(evidence_file, extension, options)
+        except OSError:
+            return None
+
+        if not os.path.exists(path):
+            return None
+
+        try:
+            with np.load(path, allow_pickle=False) as npz:
+                if int(npz["version"]) != cache_version:
+                    raise ValueError("cache version %s" % npz["version"])
+                data = {key: npz[key] for key in npz.files}
+        except Exception as error:
+            log("Disregarding cached evidence of %s (%s)"
+                % (evidence_file, error))
+            remove_file(path)
+            return None
+
+        # The modification time marks when the file was last used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return data
+
+
+    def store_chunks(self, evidence_file, engine, chunks, filtered, 
+                     options="", log=print):
+
+        # Pass on the chunks of peptide pairs that are parsed from an evidence
+        # file, and store the peptide pairs in the cache once all chunks have
+        # been parsed. The values of each chunk are encoded into arrays before
+        # the chunk is passed on, because peptide pairs are changed during 
+        # mapping, and so that no peptide pairs are kept. The references of
+        # rows that were removed while reading ("filtered", with a list of
+        # arrays per reason) are stored as well
+
+        encoded_chunks = {attribute: [] for attribute in cached_attributes}
+        # Attribute with values of multiple types, which cannot be cached
+        uncacheable = None
+
+        for chunk in chunks:
+            if uncacheable is None:
+                for attribute, encoded in encoded_chunks.items():
+                    encoded_chunk = encode_column([
+                        getattr(peptide_pair, attribute) 
+                        for peptide_pair in chunk
+                        ])
+                    if encoded_chunk is None:
+                        uncacheable = attribute
+                        encoded_chunks = None
+                        break
+                    encoded.append(encoded_chunk)
+            yield chunk
+
+        arrays = {"version": np.array(cache_version),
+                  "engine": np.array(engine)}
+        if uncacheable is None:
+            for attribute, encoded in encoded_chunks.items():
+                encoded = concatenate_columns(encoded)
+                if encoded is None:
+                    uncacheable = attribute
+                    break
+                arrays["column_" + attribute] = encoded[0]
+                if encoded[1] is not None:
+                    arrays["empty_" + attribute] = encoded[1]
+        if uncacheable is not None:
+            log("Evidence file %s is not cached: %s has values of multiple "
+                "types" % (evidence_file, uncacheable))
+            return
+
+        # References are never empty, so only the values are stored
+        reasons = list(filtered)
+        arrays["filtered_reasons"] = np.array(reasons, dtype=str)
+        for i, reason in enumerate(reasons):
+            encoded = encode_column(np.concatenate(filtered[reason]).tolist())
+            if encoded is None or (encoded[1] is not None 
+                                   and encoded[1].any()):
+                log("Evidence file %s is not cached: references have values "
+                    "of multiple types" % evidence_file)
+                return
+            arrays["filtered_%s" % i] = encoded[0]
+
+        try:
+            self.write(self.path(evidence_file, options=options), arrays)
+            self.evict()
+        except OSError as error:
+            log("Evidence file %s is not cached (%s)" % (evidence_file, error))
+
+
+    def store_sheet(self, evidence_file, engine, df, log=print):
+
+        # Store the used columns of an Excel evidence file
+
+        arrays = {"version": np.array(cache_version),
+                  "engine": np.array(engine),
+                  "col_names": np.array([str(col_name) 
+                                         for col_name in df.columns])}
+        for i, col_name in enumerate(df.columns):
+            encoded = encode_sheet_column(df[col_name])
+            if encoded is None:
+                log("Sheet of %s is not cached: column %s has values of "
+                    "multiple types" % (evidence_file, col_name))
+                return
+            arrays["column_%s" % i] = encoded[0]
+            if encoded[1] is not None:
+                arrays["missing_%s" % i] = encoded[1]
+
+        try:
+            self.write(self.path(evidence_file, ".sheet.npz"), arrays)
+            self.evict()
+        except OSError as error:
+            log("Sheet of %s is not cached (%s)" % (evidence_file, error))
+
+
+    def write(self, path, arrays):
+
+        # Write the arrays to a temporary file first, so that an interrupted
+        # write does not leave an incomplete cache file
+
+        os.makedirs(self.directory, exist_ok=True)
+        descriptor, temporary_path = tempfile.mkstemp(suffix=".tmp",
+                                                      dir=self.directory)
+        try:
+            with os.fdopen(descriptor, "wb") as f:
+                np.savez_compressed(f, **arrays)
+            os.replace(temporary_path, path)
+        except:
+            remove_file(temporary_path)
+            raise
+
+
+    def files(self):
+
+        # Return the paths of all cache files
+
+        if not os.path.isdir(self.directory):
+            return []
+
+        return [os.path.join(self.directory, name)
+                for name in os.listdir(self.directory)
+                if name.endswith(".npz")]
+
+
+    def evict(self):
+
+        # Remove the least recently used cache files until the cache fits in
+        # its maximum size
+
+        entries = []
+        for path in self.files():
+            try:
+                status = os.stat(path)
+            except OSError:
+                continue
+            entries.append((status.st_mtime, status.st_size, path))
+
+        size = sum(entry[1] for entry in entries)
+
+        for mtime, file_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            remove_file(path)
+            size -= file_size
+
+
+    def clear(self):
+
+        # Remove all cache files and return how many were removed
+
+        paths = self.files()
+        for path in paths:
+            remove_file(path)
+
+        return len(paths)
+
+
+class CachedEvidence:
+
+    # Evidence whose peptide pairs are read from a cache file, with the same
+    # interface as the classes in read_evidence
+
+
+    def __init__(self, engine, data):
+
+        self.engine = engine
+        self.columns = {}
+        self.empty = {}
+
+        for attribute in cached_attributes:
+            self.columns[attribute] = data["column_" + attribute]
+            if "empty_" + attribute in data:
+                self.empty[attribute] = data["empty_" + attribute]
+
+        self.number_of_pairs = len(self.columns[cached_attributes[0]])
+
+        self.filtered = {}
+        for i, reason in enumerate(data["filtered_reasons"].tolist()):
+            self.filtered[reason] = [data["filtered_%s" % i]]
+
+
+    def iter_chunks(self, chunk_size):
+
+        for start in range(0, self.number_of_pairs, chunk_size):
+            end = min(start + chunk_size, self.number_of_pairs)
+            peptide_pairs = [PeptidePair() for i in range(start, end)]
+            for attribute in cached_attributes:
+                values = self.columns[attribute][start:end].tolist()
+                if attribute in self.empty:
+                    empty = self.empty[attribute][start:end].tolist()
+                    values = ["" if e else v for v, e in zip(values, empty)]
+                for peptide_pair, value in zip(peptide_pairs, values):
+                    setattr(peptide_pair, attribute, value)
+            yield peptide_pairs
+
+
+def encode_column(values):
+
+    # Return an array with the values of an attribute and, for non-string
+    # values, an array marking the values that are empty strings. Return None
+    # if the values cannot be stored in a single array
+
+    values = [value.item() if isinstance(value, np.generic) else value
+              for value in values]
+    types = {type(value) for value in values
+             if not (isinstance(value, str) and value == "")}
+
+    if len(types) == 0 or types == {str}:
+        return np.array(values, dtype=str), None
+
+    value_type = types.pop()
+    if len(types) > 0 or value_type not in column_types:
+        return None
+
+    empty = np.array([isinstance(value, str) for value in values], dtype=bool)
+    column = np.array([value_type() if e else value
+                       for value, e in zip(values, empty)],
+                      dtype=column_types[value_type])
+
+    return column, empty
+
+
+def concatenate_columns(encoded_chunks):
+
+    # Concatenate the arrays of chunks that were encoded with encode_column.
+    # Chunks with only empty strings are encoded as strings, and are 
+    # converted to the type of the other chunks. Return None if the chunks
+    # have values of different types
+
+    typed = [column for column, empty in encoded_chunks if empty is not None]
+    if len(typed) == 0:
+        columns = [column for column, empty in encoded_chunks]
+        if len(columns) == 0:
+            return np.array([], dtype=str), None
+        return np.concatenate(columns), None
+
+    dtypes = {column.dtype for column in typed}
+    if len(dtypes) > 1:
+        return None
+    dtype = dtypes.pop()
+
+    columns = []
+    empties = []
+    for column, empty in encoded_chunks:
+        if empty is None:
+            if (column != "").any():
+                return None
+            empty = np.ones(len(column), dtype=bool)
+            column = np.zeros(len(column), dtype=dtype)
+        columns.append(column)
+        empties.append(empty)
+
+    return np.concatenate(columns), np.concatenate(empties)
+
+
+def encode_sheet_column(series):
+
+    # Return an array with the values of a sheet column and, for columns 
+    # with missing values that are not stored as NaN, an array marking the
+    # missing values. Return None if the values cannot be stored in a single
+    # array
+
+    if series.dtype.kind in "biuf":
+        return series.values, None
+
+    missing = series.isna().values
+    encoded = encode_column([value for value in series[~missing]])
+    if encoded is None or encoded[1] is not None:
+        return None
+
+    present = encoded[0]
+    column = np.zeros(len(series), dtype=present.dtype)
+    column[~missing] = present
+
+    return column, missing
+
+
+def decode_sheet_column(data, i):
+
+    # Return the values of a sheet column stored with encode_sheet_column.
+    # Missing values are None, as in sheets read with openpyxl
+
+    column = data["column_%s" % i]
+    if "missing_%s" % i not in data:
+        return column
+
+    missing = data["missing_%s" % i]
+    values = pd.Series(column, dtype=object)
+    values[missing] = None
+
+    return values.values
+
+
+def remove_file(path):
+
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def get_parse_cache(session):
+
+    # Return the parse cache of the session, with the size and fingerprint
+    # options from the XMAS settings
+
+    settings = get_settings(session)
+    directory = os.path.join(session.app_dirs.user_cache_dir, "evidence")
+
+    return ParseCache(directory, settings.parse_cache_size * 2**20,
+                      settings.parse_cache_content_hash)
@@ -0,0 +1,76 @@
+# Copyright 2022 Scheltema LAB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import gzip
+import time
+
+# Number of lines that are joined and written at once
+lines_per_block = 10000
+
+
+class WriteReport:
+
+    # Number of lines and bytes written to a file, and the time it took
+
+
+    def __init__(self, file_path, number_of_lines, number_of_bytes, seconds):
+
+        self.file_path = file_path
+        self.number_of_lines = number_of_lines
+        self.number_of_bytes = number_of_bytes
+        self.seconds = seconds
+
+
+    def throughput(self):
+
+        # Return a message stating the amount of data written and the rate
+
+        megabytes = self.number_of_bytes / 2**20
+        seconds = max(self.seconds, 1e-6)
+
+        return ("%s lines (%.2f MB) written in %.2f s (%.0f lines/s, "
+                "%.1f MB/s)" % (self.number_of_lines, megabytes, self.seconds,
+                                self.number_of_lines / seconds,
+                                megabytes / seconds))
+
+
+def write_unique_lines(file_path, lines, compress=None):
+
+    # Write the unique lines to a .pb (or DisVis restraints) file, in sorted
+    # order so that the file does not depend on the order of the lines.
+    # Lines are deduplicated with a set and written in blocks. The file is
+    # compressed with gzip if "compress" is True, or if it is None and the
+    # file name ends with ".gz". Return a WriteReport
+
+    start = time.perf_counter()
+
+    unique_lines = sorted(set(lines))
+    if compress is None:
+        compress = file_path.endswith(".gz")
+    if compress:
+        opener = gzip.open
+    else:
+        opener = open
+
+    number_of_bytes = 0
+    with opener(file_path, "wb") as created_file:
+        for i in range(0, len(unique_lines), lines_per_block):
+            block = unique_lines[i:i + lines_per_block]
+            data = ("\n".join(block) + "\n").encode()
+            created_file.write(data)
+            number_of_bytes += len(data)
+
+    return WriteReport(file_path, len(unique_lines), number_of_bytes,
+                       time.perf_counter() - start)
@@ -0,0 +1,375 @@
+# Copyright 2022 Scheltema LAB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+# Minimum number of peptides for which alignment is performed in parallel.
+# For fewer peptides, starting the worker processes takes longer than the
+# alignment itself
+parallel_minimum = 2000
+
+
+class PeptideIndex:
+
+    # Aho-Corasick automaton over a set of peptide sequences. The automaton is
+    # built once for all peptides of an evidence file, after which each chain
+    # sequence is scanned in a single pass to find all exact occurrences of
+    # all peptides. This replaces sliding every peptide over every chain.
+
+
+    def __init__(self, peptide_sequences):
+
+        # Each node of the automaton is an index in the lists below. Node 0 is
+        # the root. "goto" holds the outgoing transitions of a node, "fail"
+        # the node of the longest proper suffix that is also in the automaton,
+        # "peptide" the peptide sequence that ends in a node (if any), and
+        # "link" the nearest node on the fail path at which a peptide ends
+        self.goto = [{}]
+        self.fail = [0]
+        self.peptide = [None]
+        self.link = [0]
+
+        for peptide_sequence in set(peptide_sequences):
+            if peptide_sequence == "":
+                continue
+            self.add(peptide_sequence)
+
+        self.build()
+
+
+    def add(self, peptide_sequence):
+
+        # Add a peptide sequence to the trie of the automaton
+
+        node = 0
+
+        for character in peptide_sequence:
+            child = self.goto[node].get(character)
+            if child is None:
+                child = len(self.goto)
+                self.goto[node][character] = child
+                self.goto.append({})
+                self.fail.append(0)
+                self.peptide.append(None)
+                self.link.append(0)
+            node = child
+
+        self.peptide[node] = peptide_sequence
+
+
+    def build(self):
+
+        # Set the fail and output links of all nodes in breadth-first order,
+        # so that the links of shallower nodes are known when they are needed
+
+        goto, fail = self.goto, self.fail
+        peptide, link = self.peptide, self.link
+        queue = deque(goto[0].values())
+
+        while queue:
+            node = queue.popleft()
+            for character, child in goto[node].items():
+                queue.append(child)
+                state = fail[node]
+                while state and character not in goto[state]:
+                    state = fail[state]
+                fallback = goto[state].get(character, 0)
+                fail[child] = fallback
+                if peptide[fallback] is not None:
+                    link[child] = fallback
+                else:
+                    link[child] = link[fallback]
+
+
+    def scan(self, sequence):
+
+        # Scan a (chain) sequence once and return a dictionary with each
+        # peptide sequence that was found as key, and a list of its start
+        # positions on the sequence in ascending order as value
+
+        goto, fail = self.goto, self.fail
+        peptide, link = self.peptide, self.link
+        hits = {}
+        node = 0
+
+        for end, character in enumerate(sequence, 1):
+            while node and character not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(character, 0)
+            if peptide[node] is not None:
+                match = node
+            else:
+                match = link[node]
+            while match:
+                found = peptide[match]
+                start = end - len(found)
+                if found in hits:
+                    hits[found].append(start)
+                else:
+                    hits[found] = [start]
+                match = link[match]
+
+        return hits
+
+
+class ApproximatePeptideIndex:
+
+    # Finds occurrences of peptide sequences with up to a given number of
+    # mismatches, optionally treating isoleucine and leucine as equivalent.
+    # Each peptide is split into (mismatches + 1) segments. An occurrence with
+    # at most that many mismatches contains at least one of the segments
+    # without mismatches, so the segments are indexed in a PeptideIndex. Each
+    # exact occurrence of a segment gives a candidate start position of its
+    # peptide, which is then verified by counting the mismatches. Peptides
+    # that are not longer than the number of mismatches occur at every
+    # position, so they are not indexed.
+
+
+    def __init__(self, peptide_sequences, mismatches=0, il_equivalent=False):
+
+        self.mismatches = mismatches
+        self.il_equivalent = il_equivalent
+        # Dictionary with each segment as key, and a list of the peptides it
+        # belongs to (original and as compared) and its offset in the peptide
+        # as value
+        self.segments = {}
+        # Peptides that occur at every position
+        self.short_peptides = []
+
+        for peptide_sequence in set(peptide_sequences):
+            if peptide_sequence == "":
+                continue
+            query = self.normalize(peptide_sequence)
+            length = len(query)
+            if length <= mismatches:
+                self.short_peptides.append(peptide_sequence)
+                continue
+            number_of_segments = mismatches + 1
+            offsets = [length * i // number_of_segments
+                       for i in range(number_of_segments + 1)]
+            for i in range(number_of_segments):
+                segment = query[offsets[i]:offsets[i + 1]]
+                if segment not in self.segments:
+                    self.segments[segment] = []
+                self.segments[segment].append(
+                    (peptide_sequence, query, offsets[i]))
+
+        self.index = PeptideIndex(self.segments)
+
+
+    def normalize(self, sequence):
+
+        # Sequences are compared with isoleucines replaced by leucines if I
+        # and L are equivalent
+
+        if self.il_equivalent:
+            return sequence.replace("I", "L")
+
+        return sequence
+
+
+    def scan(self, sequence):
+
+        # Scan a (chain) sequence and return the start positions of the
+        # peptides in the same way as PeptideIndex.scan
+
+        target = self.normalize(sequence)
+        hits = {}
+        verified = set()
+
+        segment_hits = self.index.scan(target)
+        for segment in segment_hits:
+            for peptide_sequence, query, offset in self.segments[segment]:
+                length = len(query)
+                for segment_start in segment_hits[segment]:
+                    start = segment_start - offset
+                    if start < 0 or start + length > len(target):
+                        continue
+                    # A candidate can be found through multiple segments
+                    candidate = (peptide_sequence, start)
+                    if candidate in verified:
+                        continue
+                    verified.add(candidate)
+                    if (count_mismatches(query, target[start:start + length])
+                            > self.mismatches):
+                        continue
+                    if peptide_sequence in hits:
+                        hits[peptide_sequence].append(start)
+                    else:
+                        hits[peptide_sequence] = [start]
+
+        for peptide_sequence in self.short_peptides:
+            starts = list(range(len(target) - len(peptide_sequence) + 1))
+            if len(starts) > 0:
+                hits[peptide_sequence] = starts
+
+        for starts in hits.values():
+            starts.sort()
+
+        return hits
+
+
+def count_mismatches(sequence1, sequence2, il_equivalent=False):
+
+    # Count the positions at which two sequences of equal length differ
+
+    if il_equivalent:
+        sequence1 = sequence1.replace("I", "L")
+        sequence2 = sequence2.replace("I", "L")
+
+    return sum(1 for a, b in zip(sequence1, sequence2) if a != b)
+
+
+class AlignmentCache:
+
+    # Bounded memoization of alignments. Entries map a peptide sequence and
+    # the hash of a chain sequence to the start positions of the peptide on
+    # that chain sequence (an empty tuple when the peptide does not align).
+    # When the estimated memory use exceeds the maximum size, the least
+    # recently used entries are discarded
+
+    # Estimated memory use of an entry in bytes, excluding start positions
+    entry_size = 200
+
+
+    def __init__(self, max_size):
+
+        self.entries = OrderedDict()
+        self.max_size = max_size
+        self.size = 0
+        self.reset_counters()
+
+
+    def reset_counters(self):
+
+        self.hits = 0
+        self.misses = 0
+
+
+    def lookup(self, sequence_key, peptide_sequences):
+
+        # Return a dictionary with the start positions of the cached peptides
+        # that align to the chain sequence, and a list of the peptides for
+        # which no entry exists
+
+        entries = self.entries
+        hits = {}
+        missing = []
+
+        for peptide_sequence in peptide_sequences:
+            key = (peptide_sequence, sequence_key)
+            starts = entries.get(key)
+            if starts is None:
+                missing.append(peptide_sequence)
+                continue
+            entries.move_to_end(key)
+            if starts:
+                hits[peptide_sequence] = starts
+
+        self.hits += len(peptide_sequences) - len(missing)
+        self.misses += len(missing)
+
+        return hits, missing
+
+
+    def store(self, sequence_key, peptide_sequences, hits):
+
+        # Store the results of scanning a chain sequence for the given peptide
+        # sequences
+
+        entries = self.entries
+
+        for peptide_sequence in peptide_sequences:
+            key = (peptide_sequence, sequence_key)
+            if key in entries:
+                continue
+            starts = tuple(hits.get(peptide_sequence, ()))
+            entries[key] = starts
+            self.size += self.entry_size + 8 * len(starts)
+
+        while self.size > self.max_size and entries:
+            _, starts = entries.popitem(last=False)
+            self.size -= self.entry_size + 8 * len(starts)
+
+
+def scan_sequences(peptide_sequences, sequences, mismatches=0,
+                   il_equivalent=False):
+
+    # Scan each sequence for all peptide sequences with a single index.
+    # Return a list with, for each sequence, the dictionary returned by
+    # PeptideIndex.scan. Approximate occurrences are found when mismatches
+    # are allowed or I and L are equivalent. This function only uses strings,
+    # so it can be run in a worker process
+
+    if mismatches > 0 or il_equivalent:
+        peptide_index = ApproximatePeptideIndex(peptide_sequences, mismatches,
+                                                il_equivalent)
+    else:
+        peptide_index = PeptideIndex(peptide_sequences)
+
+    return [peptide_index.scan(sequence) for sequence in sequences]
+
+
+def align_sequences(peptide_sequences, sequences, workers=1, mismatches=0,
+                    il_equivalent=False, executor=None):
+
+    # Scan the (chain) sequences for the peptide sequences, in parallel if
+    # multiple workers are allowed. Building the index takes much longer than
+    # scanning a sequence, so the peptides are divided over the workers, and
+    # each worker scans all sequences for its share of the peptides. The
+    # workers of the given executor are used, so that they can be kept 
+    # between calls. Without executor, worker processes are started for 
+    # this call only. The results are the same as for scan_sequences
+
+    peptide_sequences = sorted(set(peptide_sequences))
+    workers = min(workers, len(peptide_sequences) // parallel_minimum + 1)
+    parameters = (mismatches, il_equivalent)
+
+    if workers > 1:
+        shares = [peptide_sequences[i::workers] for i in range(workers)]
+        try:
+            if executor is None:
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    results = scan_shares(executor, shares, sequences,
+                                          parameters)
+            else:
+                results = scan_shares(executor, shares, sequences, 
+                                      parameters)
+        except Exception as error:
+            # Fall back on serial alignment when the worker processes
+            # cannot be used, e.g. when they cannot be started or the 
+            # arguments cannot be pickled
+            print("Parallel alignment failed (%s), aligning serially"
+                  % error)
+        else:
+            merged = [{} for sequence in sequences]
+            for result in results:
+                for i, hits in enumerate(result):
+                    merged[i].update(hits)
+            return merged
+
+    return scan_sequences(peptide_sequences, sequences, *parameters)
+
+
+def scan_shares(executor, shares, sequences, parameters):
+
+    # Scan the sequences for each share of the peptide sequences in a worker
+    # of the executor
+
+    futures = [executor.submit(scan_sequences, share, sequences, *parameters)
+               for share in shares]
+
+    return [future.result() for future in futures]
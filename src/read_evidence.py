@@ -13,12 +13,30 @@
 # limitations under the License.
 
 
-from csv import Sniffer
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from csv import reader, Sniffer
+from itertools import chain, islice
 from operator import attrgetter
+import numpy as np
 import pandas as pd
 
 double_attributes = {"Sequences": ["SequenceA", "SequenceB"],
                      "Positions": ["XLinkPositionA", "XLinkPositionB"]}
+# Number of characters read from the start of non-Excel evidence files to 
+# find the header, delimiter, decimal separator and pLink sub-header
+sample_size = 2**16
+# Attributes of peptide pairs that are obtained from evidence files, in the
+# order in which PeptidePair.from_values assigns them
+evidence_attributes = ["Ref", "Score", "CrossLinker", "CrosslinkType", 
+                       "SequenceA", "ModificationsA", "AccessionA", 
+                       "XLinkPositionA", "PositionA", "SequenceB", 
+                       "ModificationsB", "XLinkPositionB", "AccessionB", 
+                       "PositionB", "ProteinDescriptionsA", 
+                       "ProteinDescriptionsB", "IsDecoy", "QValue", "NumCSMs"]
+# Peptide pairs share this empty tuple until their first alignment is added,
+# since most peptide pairs of an evidence file do not align
+no_alignments = ()
 
 
 # Enable evidence files from multiple results files and input formats to be
@@ -26,17 +44,141 @@ double_attributes = {"Sequences": ["SequenceA", "SequenceB"],
 class Evidence:
 
     
-    def __init__(self, evidence_file):
-        
+    def __init__(self, evidence_file, parse_cache=None, minimum_score=None,
+                 log=print):
+        
+        # Messages are passed to the "log" function, so that evidence files
+        # can be read in worker threads
+        self.evidence_file = evidence_file
+        self.parse_cache = parse_cache
+        self.log = log
+        # Cached peptide pairs depend on the filters applied while reading
+        self.options = "minimum_score=%s" % minimum_score
+        
+        # Evidence files that have been parsed before are read from the
+        # parse cache, if one is given
+        self.cached = None
+        if parse_cache is not None:
+            self.cached = parse_cache.load(evidence_file, self.options, log)
+            
         # Use a specific class to parse mzIdentML files
-        if evidence_file.endswith(".mzid"):
-            cls = MzIdentML
+        if self.cached is not None:
+            self.evidence = self.cached
+        elif evidence_file.endswith(".mzid"):
+            self.evidence = MzIdentML(evidence_file)
         else:
-            cls = Tabular
+            self.evidence = Tabular(evidence_file, parse_cache, minimum_score,
+                                    log)
+        
+        self.engine = self.evidence.engine
+        
+        
+    def iter_chunks(self, chunk_size):
+        
+        # Yield the peptide pairs of the evidence file in lists of at most
+        # "chunk_size" peptide pairs, so that not all of them need to be 
+        # kept in memory at once
+        
+        chunks = self.evidence.iter_chunks(chunk_size)
+        
+        # Store newly parsed peptide pairs in the parse cache
+        if self.parse_cache is not None and self.cached is None:
+            chunks = self.parse_cache.store_chunks(self.evidence_file, 
+                                                   self.engine, chunks,
+                                                   self.evidence.filtered,
+                                                   self.options, self.log)
+        
+        return chunks
+    
+    
+    def filtered_refs(self):
+        
+        # Return a dictionary with, for each reason for which rows were 
+        # removed while reading the evidence file, the references of the 
+        # removed rows. Complete only after all chunks have been read
+        
+        return {reason: np.concatenate(refs).tolist() 
+                for reason, refs in self.evidence.filtered.items()}
+        
+        
+class ReadEvidence:
+    
+    # Evidence of which all chunks have been read, so that an evidence file
+    # can be read completely in a worker thread. It has the same interface as
+    # Evidence
+    
+    
+    def __init__(self, evidence, chunk_size):
         
-        evidence = cls(evidence_file)
-        self.peptide_pairs = evidence.peptide_pairs
         self.engine = evidence.engine
+        self.cached = evidence.cached
+        self.chunks = list(evidence.iter_chunks(chunk_size))
+        self.filtered = evidence.filtered_refs()
+        
+        
+    def iter_chunks(self, chunk_size):
+        
+        # The chunks are released when they have been passed on
+        
+        while self.chunks:
+            yield self.chunks.pop(0)
+            
+            
+    def filtered_refs(self):
+        
+        return self.filtered
+    
+    
+def read_evidence_files(evidence_files, chunk_size, workers=1, 
+                        parse_cache=None, minimum_score=None):
+    
+    # Yield a tuple with each evidence file, its evidence, and the error that
+    # was raised while reading it (None if it was read), in the order of the
+    # files. With multiple workers, files are read in threads while the 
+    # evidence of preceding files is used, with at most "workers" files read
+    # ahead. Otherwise, each file is read in chunks when its evidence is used.
+    # Messages from worker threads are collected, and printed in the main
+    # thread before the evidence of their file is yielded
+    
+    if workers <= 1 or len(evidence_files) <= 1:
+        for evidence_file in evidence_files:
+            try:
+                evidence = Evidence(evidence_file, parse_cache, minimum_score)
+            except Exception as error:
+                yield evidence_file, None, error
+                continue
+            yield evidence_file, evidence, None
+        return
+    
+    def read(evidence_file, messages):
+        evidence = Evidence(evidence_file, parse_cache, minimum_score, 
+                            messages.append)
+        return ReadEvidence(evidence, chunk_size)
+    
+    def submit(evidence_file):
+        messages = []
+        future = executor.submit(read, evidence_file, messages)
+        return evidence_file, future, messages
+    
+    files = iter(evidence_files)
+    
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = deque(submit(evidence_file) 
+                        for evidence_file in islice(files, workers))
+        while futures:
+            evidence_file, future, messages = futures.popleft()
+            # Start reading the next file before the evidence is used
+            for next_file in islice(files, 1):
+                futures.append(submit(next_file))
+            try:
+                evidence = future.result()
+                read_error = None
+            except Exception as error:
+                evidence = None
+                read_error = error
+            for message in messages:
+                print(message)
+            yield evidence_file, evidence, read_error
         
         
 # Read evidence from mzIdentML files            
@@ -50,8 +192,16 @@ class MzIdentML:
         
         self.peptide_pairs = parse_xl_peptides(evidence_file)
         self.engine = "mzIdentML"
+        # No rows are removed while reading mzIdentML files
+        self.filtered = {}
         for peptide_pair in self.peptide_pairs:
             sort_peptides(peptide_pair)
+            
+            
+    def iter_chunks(self, chunk_size):
+        
+        for start in range(0, len(self.peptide_pairs), chunk_size):
+            yield self.peptide_pairs[start:start + chunk_size]
                 
     
 # Read evidence from files with tabular format (*.csv, *.tsv, *.txt, *.xls
@@ -59,7 +209,8 @@ class MzIdentML:
 class Tabular:
 
     
-    def __init__(self, evidence_file):
+    def __init__(self, evidence_file, parse_cache=None, minimum_score=None,
+                 log=print):
         
         import os
         
@@ -82,29 +233,176 @@ class Tabular:
                                             "Score", "IsDecoy"],
                                            self.parse_xlinkx_xi_seqs_scores, 
                                            self.parse_xi_pos_ids]}
-        
-        # Get header and delimiter
+        # Dictionary with, for each search engine, the columns that are used
+        # in addition to those listed above. Only the used columns are read
+        # from the evidence file
+        self.extra_columns = {"XlinkX": [],
+                              "pLink": ["Peptide_Order"],
+                              "Xi": ["FromSite", "ToSite", "PeptidePairID"],
+                              "Xi_alternative": ["LinkPos1", "LinkPos2", 
+                                                 "PSMID"]}
+        
+        # Get header and delimiter. For non-Excel files, these are obtained
+        # from a sample of the first lines, so that the file is read 
+        # completely only once, when the dataframe is made
         extension = os.path.splitext(evidence_file)[1][1:]
         self.is_excel = (extension == "xls" or extension == "xlsx") 
-        header, delimiter = self.parse_headers(evidence_file)
+        # Workbooks of *.xlsx files are opened once, in read-only mode, and
+        # their rows are read as a stream
+        self.workbook = None
+        # Rows of peptide pairs with a lower score are removed while reading
+        # (None for no minimum). The references of removed rows are stored
+        # per reason, as an array per chunk
+        self.minimum_score = minimum_score
+        self.filtered = {}
+        # Non-Excel files other than pLink are read in chunks, with these 
+        # parameters, instead of into a single dataframe
+        self.read_parameters = None
+        self.log = log
+        
+        # The used columns of Excel sheets are stored in the parse cache, so
+        # that the workbook need not be opened again
+        if self.is_excel and parse_cache is not None:
+            cached = parse_cache.load_sheet(evidence_file, log)
+            if cached is not None:
+                self.engine, self.df = cached
+                return
+            
+        # The workbook is closed once the sheet has been read, also when 
+        # reading fails
+        try:
+            header, delimiter = self.parse_headers(evidence_file)
+            
+            # Get engine with header
+            engine = self.parse_engine(header)
+            
+            if engine == "":
+                self.log("Unsupported evidence file format")
+                return
+            
+            self.engine = engine
+            
+            # Make the dataframe
+            self.df = self.make_df(evidence_file, delimiter, header)
+        finally:
+            if self.workbook is not None:
+                self.workbook.close()
         
-        # Get engine with header
-        engine = self.parse_engine(header)
+        if self.is_excel and parse_cache is not None:
+            parse_cache.store_sheet(evidence_file, self.engine, self.df, log)
         
-        if engine == "":
-            print("Unsupported evidence file format")
+        
+    def iter_chunks(self, chunk_size):
+        
+        # Obtain the relevant information by calling the search engine-specific
+        # function on consecutive parts of the dataframe. Peptide pairs are 
+        # only created for one part at a time
+        
+        if self.engine != "pLink":
+            for chunk in self.read_chunks(chunk_size):
+                chunk = self.filter_chunk(chunk)
+                yield self.engines[self.engine][1](chunk)
             return
         
-        self.engine = engine
+        df = self.df
         
-        # Make the dataframe
-        df = self.make_df(evidence_file, delimiter, header)
+        # pLink evidence files have a two-dimensional header. The upper header
+        # corresponds to unique peptide pairs. The lower header corresponds to 
+        # spectra belonging to a peptide pair. The lower (sub-) header is read 
+        # and, subsequently, removed from the dataframe for convenience
+        self.subheader = df.iloc[0,:].values.tolist()
+        df = df.iloc[1:]
+        # A peptide pair and its spectra should be in the same part, so
+        # parts can only start at rows containing a peptide pair
+        group_starts = df.index[df["Peptide_Order"].notna()]
+        bounds = [df.index.get_loc(i) for i in group_starts[::chunk_size]]
+        bounds.append(len(df.index))
+            
+        for i in range(len(bounds) - 1):
+            chunk = df.iloc[bounds[i]:bounds[i + 1]]
+            yield self.engines[self.engine][1](chunk)
         
-        # Obtain the relevant information by calling the search engine-specific
-        # function
-        self.engines[engine][1](df)
         
+    def read_chunks(self, chunk_size):
+        
+        # Yield consecutive parts of the dataframe. Files that are read in 
+        # chunks are read here, so that only one chunk is in memory at once. 
+        # If a column does not match its dtype, the file is read again as 
+        # given by "read_attempts", skipping the chunks that have been yielded
+        
+        if self.read_parameters is None:
+            for start in range(0, len(self.df.index), chunk_size):
+                yield self.df.iloc[start:start + chunk_size]
+            return
+        
+        evidence_file, usecols, dtype, kwargs = self.read_parameters
+        attempts = self.read_attempts(dtype, kwargs)
+        number_of_chunks = 0
+        
+        for i, (attempt_dtype, attempt_kwargs) in enumerate(attempts):
+            try:
+                with pd.read_csv(evidence_file, usecols=usecols, 
+                                 dtype=attempt_dtype, chunksize=chunk_size, 
+                                 **attempt_kwargs) as chunks:
+                    for j, chunk in enumerate(chunks):
+                        if j >= number_of_chunks:
+                            yield chunk
+                            number_of_chunks += 1
+                return
+            except (TypeError, ValueError):
+                if i == len(attempts) - 1:
+                    raise
+                        
+                        
+    def filter_chunk(self, df):
+        
+        # Remove the rows of decoys, of peptide pairs with lacking sequences
+        # and of peptide pairs with a score below the minimum from a part of
+        # the dataframe, before peptide pairs are created. The references of
+        # the removed rows are stored per reason
+        
+        col_names = self.engines[self.engine][0]
+        removed = pd.Series(False, index=df.index)
+        
+        if col_names[3] in df.columns:
+            removed |= df[col_names[3]].astype(bool)
+        for col_name in col_names[:2]:
+            if col_name not in df.columns:
+                removed[:] = True
+                continue
+            seqs = df[col_name]
+            removed |= (seqs.isna() 
+                        | pd.to_numeric(seqs, errors="coerce").notna())
+        masks = {"Sequence lacking/decoy": removed}
+        
+        if self.minimum_score is not None and col_names[2] in df.columns:
+            scores = pd.to_numeric(df[col_names[2]], errors="coerce")
+            below_minimum = (scores < self.minimum_score) & ~removed
+            masks["Score below %s" % self.minimum_score] = below_minimum
+            removed = removed | below_minimum
+            
+        for reason, mask in masks.items():
+            if not mask.any():
+                continue
+            if reason not in self.filtered:
+                self.filtered[reason] = []
+            self.filtered[reason].append(self.refs(df[mask.values]))
+            
+        return df[~removed.values]
+    
+    
+    def refs(self, df):
+        
+        # Return the references of the rows of (a part of) the dataframe. For
+        # XlinkX, this is the row number in the evidence file, obtained from 
+        # the dataframe index
+        
+        if self.engine == "XlinkX":
+            return (df.index + 2).values
         
+        return df[self.extra_columns[self.engine][2]].values
+    
+    
     def parse_xlinkx_xi_seqs_scores(self, df):
         
         # XlinkX and Xi evidence files have a similar structure. This method 
@@ -115,139 +413,167 @@ class Tabular:
         col_names, function = parameters[0], parameters[2]
              
         attributes = (double_attributes["Sequences"] + ["Score", "IsDecoy"])
-        range_xlinks = range(len(df.index))
-        # Each peptide pair is stored as an instance of class PeptidePair
-        peptide_pairs = [PeptidePair() for i in range_xlinks]
+        # The peptide pairs are stored column-wise in a PeptidePairTable
+        table = PeptidePairTable(df.index)
             
         for i in range(len(col_names)):
-            try:
-                values = df[col_names[i]].tolist()
-            except:
+            if col_names[i] not in df.columns:
                 continue
-            for j in range_xlinks:
-                peptide_pair = peptide_pairs[j]
-                setattr(peptide_pair, attributes[i], values[j])
+            table.df[attributes[i]] = df[col_names[i]].values
             
-        function(peptide_pairs, df, xi_alternative)
-        self.peptide_pairs = peptide_pairs
+        function(table, df, xi_alternative)
+        
+        return table.peptide_pairs()
         
         
-    def parse_xlinkx_pos_ids(self, peptide_pairs, *args):
+    def parse_xlinkx_pos_ids(self, table, df, *args):
         
         # Parse the crosslink positions and peptide pair references of XlinkX
-        # evidence files
-        
-        for i, peptide_pair in enumerate(peptide_pairs):
-            peptide_pair.Ref = i + 2
-            for j, seq_attr in enumerate(double_attributes["Sequences"]):
-                seq = getattr(peptide_pair, seq_attr)
-                pos_attr = double_attributes["Positions"][j]
-                if peptide_pair.invalid(seq_attr):
-                    pos = ""
-                    seq_new = ""
-                elif seq.count("[") == 0: 
-                    pos = 0
-                    seq_new = seq
-                else:
-                    pos = seq.index("[")
-                    seq_new = seq.replace("[", "").replace("]", "")
-                setattr(peptide_pair, pos_attr, pos)
-                setattr(peptide_pair, seq_attr, seq_new)
-            sort_peptides(peptide_pair)
+        # evidence files. The crosslinked residue is enclosed in brackets; 
+        # its position is that of the opening bracket. Rows with invalid
+        # sequences have been removed in "filter_chunk"
+        
+        table.df["Ref"] = self.refs(df)
+        
+        for j, seq_attr in enumerate(double_attributes["Sequences"]):
+            pos_attr = double_attributes["Positions"][j]
+            seqs = table.df[seq_attr].astype(str).tolist()
+            table.df[pos_attr] = [max(seq.find("["), 0) for seq in seqs]
+            table.df[seq_attr] = [seq.replace("[", "").replace("]", "") 
+                                  for seq in seqs]
+            
+        table.sort_peptides()
             
             
     def parse_plink(self, df):
         
-        # Parse pLink evidence files
-        
-        from numpy import isnan
-        import re
-        
-        # pLink evidence files have a two-dimensional header. The upper header
-        # corresponds to unique peptide pairs. The lower header corresponds to 
-        # spectra belonging to a peptide pair. The lower (sub-) header is read 
-        # and, subsequently, removed from the dataframe for convenience
-        subheader = df.iloc[0,:].values.tolist()
-        df.drop(index=df.index[0], axis=0, inplace=True)
-        peptide_pairs = []  
-        
-        # Helper function to extract sequences and crosslink positions
-        def parse_seq_pos(value):
-            sequences = re.findall("[A-Z]+", value)
-            positions = re.findall("[0-9]+", value)
-            return sequences, positions
-
-        for row in df.itertuples():
-            ref = row.Peptide_Order
-            # If the Peptide_Order cell contains a value, the row contains
-            # peptide pair data. If not, it contains spectra data
-            if not isnan(ref):
-                peptide_pair = PeptidePair()
-                peptide_pairs.append(peptide_pair)
-                peptide_pair.Ref = int(ref)
-                sequences, positions = parse_seq_pos(row.Peptide)
-                for i, seq_attr in enumerate(double_attributes["Sequences"]):
-                    setattr(peptide_pair, seq_attr, sequences[i])
-                    setattr(peptide_pair, double_attributes["Positions"][i], 
-                            int(positions[i]) - 1)
-                sort_peptides(peptide_pair)
-                continue
-            data = list(row)[1:]
-            sub_pair = dict(zip(subheader, data))
-            score = float(sub_pair["Score"])
-            if (peptide_pair.Score == "" or peptide_pair.Score < score):
-                peptide_pair.Score = score
+        # Parse pLink evidence files. Rows with a value in the Peptide_Order
+        # column contain peptide pair data. The rows that follow a peptide 
+        # pair, until the next peptide pair, contain data of its spectra
+        
+        # The sub-header has been removed from the dataframe in "iter_chunks"
+        score_col = df.columns[self.subheader.index("Score")]
+        
+        orders = df["Peptide_Order"]
+        is_pair = orders.notna()
+        # Number the peptide pairs, and give spectra the number of their
+        # peptide pair
+        groups = is_pair.cumsum()
+        
+        # The score of a peptide pair is the highest score of its spectra
+        spectra = ~is_pair
+        scores = pd.to_numeric(df[score_col][spectra], errors="coerce")
+        max_scores = scores.groupby(groups[spectra]).max()
+        max_scores = max_scores.reindex(groups[is_pair].values)
+        
+        # Peptides are written as SEQUENCE(position)-SEQUENCE(position)
+        peptides = df["Peptide"][is_pair].astype(str).str.extract(
+            r"([A-Z]+)[^A-Z0-9]*([0-9]+)[^A-Z0-9]*([A-Z]+)[^A-Z0-9]*([0-9]+)"
+            )
+        parsed = peptides.notna().all(axis=1)
+        
+        table = PeptidePairTable(peptides.index)
+        table.df["Ref"] = orders[is_pair].astype(int).values
+        table.df["Score"] = pd.Series(max_scores.values, index=table.df.index,
+                                      dtype=object).where(
+                                          max_scores.notna().values, "")
+        for i, seq_attr in enumerate(double_attributes["Sequences"]):
+            pos_attr = double_attributes["Positions"][i]
+            seqs = peptides[2 * i].where(parsed, "")
+            pos = pd.to_numeric(peptides[2 * i + 1].where(parsed, 0)) - 1
+            table.df[seq_attr] = seqs.values
+            table.df[pos_attr] = pos.astype(object).where(parsed, "").values
+            
+        table.sort_peptides()
                 
-            self.peptide_pairs = peptide_pairs
+        return table.peptide_pairs()
         
             
-    def parse_xi_pos_ids(self, peptide_pairs, df, alternative):
+    def parse_xi_pos_ids(self, table, df, alternative):
         
         # Parse crosslink positions and peptide references for Xi evidence 
         # files
         
-        # Dictionary containing the relevant column names for Xi (False) and
-        # Xi_alternative (True)
-        col_names = {False: ["FromSite", "ToSite", "PeptidePairID"],
-                     True: ["LinkPos1", "LinkPos2", "PSMID"]}
+        # The relevant column names for Xi and Xi_alternative
+        col_names = self.extra_columns[self.engine]
         keys = double_attributes["Positions"] + ["Ref"]
         
-        params = {}
-        for i, key in enumerate(keys):
-            col_name = col_names[alternative][i]
-            params[key] = df[col_name].tolist()
-            
-        for i, peptide_pair in enumerate(peptide_pairs):
-            peptide_pair.Ref = params["Ref"][i]
-            for j, key in enumerate(keys[:2]):
-                seq_attr = double_attributes["Sequences"][j]
-                pos_attr = key
-                if peptide_pair.invalid(seq_attr):
-                    seq = ""
-                    pos = ""
-                else:
-                    seq = getattr(peptide_pair, seq_attr)
-                    residues = [res for res in seq if res.isupper()]
-                    seq = "".join(residues)
-                    pos = params[key][i] - 1
-                setattr(peptide_pair, seq_attr, seq)
-                setattr(peptide_pair, pos_attr, pos)
+        table.df["Ref"] = self.refs(df)
+        
+        # Modifications are written in lowercase characters, which are 
+        # removed from the sequences. Rows with invalid sequences have been
+        # removed in "filter_chunk"
+        for j, key in enumerate(keys[:2]):
+            seq_attr = double_attributes["Sequences"][j]
+            seqs = table.df[seq_attr].astype(str)
+            table.df[key] = df[col_names[j]].values - 1
+            table.df[seq_attr] = seqs.str.replace("[^A-Z]", "", regex=True)
                 
         
     def parse_headers(self, evidence_file):
         
-        if self.is_excel:
+        if self.is_excel and evidence_file.endswith(".xls"):
             df = pd.read_excel(evidence_file, nrows=0)
             header = df.columns.values.tolist()
             return header, None
         
+        if self.is_excel:
+            from openpyxl import load_workbook
+            self.workbook = load_workbook(evidence_file, read_only=True, 
+                                          data_only=True)
+            # The evidence is on the first sheet, as read by Pandas
+            self.rows = self.workbook.worksheets[0].iter_rows(
+                values_only=True)
+            # Name columns without header in the same way as Pandas
+            header = ["Unnamed: %s" % i if value is None else str(value) 
+                      for i, value in enumerate(next(self.rows, ()))]
+            return header, None
+        
+        # Read the first lines of the file. The last line of the sample is 
+        # disregarded if it may be incomplete
         with open(evidence_file) as f:
-            line = f.readline().rstrip()
-        dialect = Sniffer().sniff(line)
+            sample = f.read(sample_size)
+        lines = sample.splitlines()
+        if len(sample) == sample_size and len(lines) > 1:
+            lines = lines[:-1]
+            
+        dialect = Sniffer().sniff(lines[0].rstrip())
         delimiter = dialect.delimiter
-        header = line.split(delimiter)
+        # The rows of the sample are used to find the sub-header of pLink 
+        # files and the decimal separator
+        self.sample_rows = list(reader(lines, delimiter=delimiter))
+        header = self.sample_rows[0]
             
         return header, delimiter
+    
+    
+    def parse_decimal(self, delimiter):
+        
+        # Find the decimal separator from the scores in the sample rows. A
+        # decimal comma is only possible if the delimiter is not a comma
+        
+        if delimiter == ",":
+            return "."
+        
+        score_col = self.engines[self.engine][0][2]
+        header = self.sample_rows[0]
+        if score_col not in header:
+            return "."
+        score_index = header.index(score_col)
+        
+        for row in self.sample_rows[1:]:
+            if len(row) <= score_index:
+                continue
+            score = row[score_index].strip()
+            if "," not in score:
+                continue
+            try:
+                float(score.replace(",", "."))
+            except ValueError:
+                continue
+            return ","
+        
+        return "."
                 
                 
     def parse_engine(self, header):
@@ -270,41 +596,185 @@ class Tabular:
         # Write evidence file to a Pandas dataframe. Approach differs between
         # Excel (xlsx) files, non-Excel non-pLink files, and non-Excel pLink
         # files
-        if self.is_excel:
-            df = pd.read_excel(evidence_file)
+        if self.is_excel and self.workbook is not None:
+            df = self.read_sheet(header)
             return df
         
-        if self.engine != "pLink":        
-            df = pd.read_csv(evidence_file, sep=delimiter, 
-                             decimal=".")
-            score_col = self.engines[self.engine][0][2]
-            try:
-                if (df[score_col].dtypes != "float64" and delimiter != ","):
-                    df = pd.read_csv(evidence_file, sep=delimiter, decimal=",")
-            except:
-                pass
+        if self.is_excel:
+            if self.engine == "pLink":
+                return pd.read_excel(evidence_file)
+            usecols, dtype = self.schema(header)
+            df = self.read(pd.read_excel, evidence_file, usecols, dtype)
             return df
         
+        if self.engine != "pLink":
+            usecols, dtype = self.schema(header)
+            self.read_parameters = (evidence_file, usecols, dtype, 
+                                    {"sep": delimiter, 
+                                     "decimal": self.parse_decimal(delimiter)})
+            return None
+        
         # For non-Excel pLink files, header might need to be adjusted, since  
         # the first row (the sub-header) can contain more cells than the 
         # header, which causes problems when converting to dataframe.
-        with open(evidence_file) as f:
-            f.readline()
-            subheader = f.readline().rstrip().split(delimiter)
+        if len(self.sample_rows) > 1:
+            subheader = self.sample_rows[1]
+        else:
+            subheader = []
         missing_cells = len(subheader) - len(header)
         if missing_cells > 0:
             addition = ["Unnamed: %s" % i for i in range(missing_cells)]
             col_names = header + addition
         else:
-            col_names = header   
-        df = pd.read_csv(evidence_file, sep=delimiter, header=0, 
-                         names=col_names, decimal=".")
+            col_names = header
+        usecols, dtype = self.schema(col_names, subheader)
+        df = self.read(pd.read_csv, evidence_file, usecols, dtype, 
+                       sep=delimiter, header=0, names=col_names, decimal=".")
             
         return df
     
     
+    def read_sheet(self, header):
+        
+        # Read the used columns from the rows of the worksheet that follow 
+        # the header. The first of these rows is the sub-header for pLink
+        
+        first_row = next(self.rows, ())
+        usecols, dtype = self.schema(header, list(first_row))
+        indices = [header.index(col_name) for col_name in usecols]
+        columns = [[] for col_name in usecols]
+        last_row = 0
+        
+        for i, row in enumerate(chain([first_row], self.rows)):
+            values = [row[j] if j < len(row) else None for j in indices]
+            for column, value in zip(columns, values):
+                column.append(value)
+            if any(value is not None for value in values):
+                last_row = i + 1
+        
+        # Empty rows at the end of the sheet are not part of the evidence
+        df = pd.DataFrame({col_name: column[:last_row] 
+                           for col_name, column in zip(usecols, columns)})
+            
+        return df
+    
+    
+    def schema(self, col_names, subheader=None):
+        
+        # Return the names of the columns that are used for the search 
+        # engine, and the dtypes of the sequence and score columns. For 
+        # pLink, the score column is found from the sub-header
+        
+        parameters = self.engines[self.engine]
+        
+        if self.engine == "pLink":
+            used = ["Peptide_Order", "Peptide"]
+            if "Score" in subheader:
+                used.append(col_names[subheader.index("Score")])
+            dtype = {"Peptide": str}
+        else:
+            used = parameters[0] + self.extra_columns[self.engine]
+            dtype = {col_name: str for col_name in parameters[0][:2]}
+            dtype[parameters[0][2]] = "float64"
+            
+        usecols = [col_name for col_name in used if col_name in col_names]
+        dtype = {col_name: dtype[col_name] for col_name in dtype 
+                 if col_name in usecols}
+        
+        return usecols, dtype
+    
+    
+    def read(self, function, evidence_file, usecols, dtype, **kwargs):
+        
+        # Read the used columns of an evidence file with the given dtypes. If
+        # a column does not match its dtype (e.g. a score column containing
+        # text), the file is read again as given by "read_attempts"
+        
+        attempts = self.read_attempts(dtype, kwargs)
+        
+        for i, (attempt_dtype, attempt_kwargs) in enumerate(attempts):
+            try:
+                return function(evidence_file, usecols=usecols, 
+                                dtype=attempt_dtype, **attempt_kwargs)
+            except (TypeError, ValueError):
+                if i == len(attempts) - 1:
+                    raise
+    
+    
+    def read_attempts(self, dtype, kwargs):
+        
+        # Return the dtypes and keyword arguments with which an evidence file
+        # is read, in order of preference. The decimal separator is found from
+        # a sample of the file, so a decimal comma later in the file is only
+        # noticed when a score cannot be read. Therefore, if the delimiter is
+        # not a comma, a decimal comma is tried before dtypes are inferred
+        
+        attempts = [(dtype, kwargs)]
+        if (kwargs.get("sep", ",") != "," 
+                and kwargs.get("decimal", ".") != ","):
+            attempts.append((dtype, dict(kwargs, decimal=",")))
+        attempts.append((None, kwargs))
+        
+        return attempts
+    
+    
+class PeptidePairTable:
+    
+    # Column-wise representation of peptide pairs. The dataframe has a 
+    # column for each PeptidePair attribute (except the alignments) and a row
+    # for each peptide pair, so that evidence can be parsed with operations 
+    # on whole columns. PeptidePair objects are created for the rows with 
+    # "peptide_pairs"
+    
+    
+    def __init__(self, index):
+        
+        defaults = PeptidePair()
+        self.df = pd.DataFrame({attribute: getattr(defaults, attribute) 
+                                for attribute in evidence_attributes}, 
+                               index=index, dtype=object)
+        
+        
+    def __len__(self):
+        
+        return len(self.df.index)
+    
+    
+    def sort_peptides(self):
+        
+        # Sort the peptides of all peptide pairs based on sequence, in the 
+        # same way as the "sort_peptides" function
+        
+        df = self.df
+        seq_attributes = double_attributes["Sequences"]
+        pos_attributes = double_attributes["Positions"]
+        swap = (df[seq_attributes[0]] > df[seq_attributes[1]]).values
+        
+        if not swap.any():
+            return
+        
+        for attributes in (seq_attributes, pos_attributes):
+            df.loc[swap, attributes] = df.loc[swap, attributes[::-1]].values
+            
+            
+    def peptide_pairs(self):
+        
+        # Return a PeptidePair object for each row
+        
+        columns = [self.df[attribute].tolist() 
+                   for attribute in evidence_attributes]
+        from_values = PeptidePair.from_values
+        
+        return [from_values(values) for values in zip(*columns)]
+    
+    
 class PeptidePair:
     
+    # Evidence files can contain millions of peptide pairs, so their 
+    # attributes are stored in slots instead of a dictionary per instance
+    __slots__ = evidence_attributes + ["AlignmentsA", "AlignmentsB", 
+                                       "has_overlapping"]
+    
     
     def __init__(self):
         
@@ -327,8 +797,47 @@ class PeptidePair:
         self.IsDecoy = False
         self.QValue = 0
         self.NumCSMs = 1
-        self.AlignmentsA = []
-        self.AlignmentsB = []
+        self.AlignmentsA = no_alignments
+        self.AlignmentsB = no_alignments
+        self.has_overlapping = False
+        
+        
+    @classmethod
+    def from_values(cls, values):
+        
+        # Create a peptide pair with the values of the evidence attributes,
+        # in the order of "evidence_attributes". Peptide pairs are created 
+        # for every row of an evidence file, so "__init__" is skipped and 
+        # each slot is assigned once
+        
+        peptide_pair = cls.__new__(cls)
+        (peptide_pair.Ref, peptide_pair.Score, peptide_pair.CrossLinker, 
+         peptide_pair.CrosslinkType, peptide_pair.SequenceA, 
+         peptide_pair.ModificationsA, peptide_pair.AccessionA, 
+         peptide_pair.XLinkPositionA, peptide_pair.PositionA, 
+         peptide_pair.SequenceB, peptide_pair.ModificationsB, 
+         peptide_pair.XLinkPositionB, peptide_pair.AccessionB, 
+         peptide_pair.PositionB, peptide_pair.ProteinDescriptionsA, 
+         peptide_pair.ProteinDescriptionsB, peptide_pair.IsDecoy, 
+         peptide_pair.QValue, peptide_pair.NumCSMs) = values
+        peptide_pair.AlignmentsA = no_alignments
+        peptide_pair.AlignmentsB = no_alignments
+        peptide_pair.has_overlapping = False
+            
+        return peptide_pair
+    
+    
+    def add_alignment(self, letter, alignment):
+        
+        # Add an alignment of peptide A or B. The list of alignments is 
+        # created when the first alignment is added
+        
+        attribute = "Alignments" + letter
+        alignments = getattr(self, attribute)
+        if alignments is no_alignments:
+            alignments = []
+            setattr(self, attribute, alignments)
+        alignments.append(alignment)
         
         
     def get_info(self, attr="Sequence"):
@@ -337,24 +846,6 @@ class PeptidePair:
         f = attrgetter(attr + "A", attr + "B")
         
         return f(self)  
-    
-    
-    def invalid(self, seq_attr):
-        
-        # If sequence is from a decoy peptide or is not a string, it cannot be
-        # used for mapping(/alignment)
-        seq = getattr(self, seq_attr)
-        
-        if self.IsDecoy:
-            return True
-        
-        try:
-            float(seq)
-            invalid = True
-        except:
-            invalid = False
-            
-        return invalid
             
                     
 def sort_peptides(peptide_pair):
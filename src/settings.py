@@ -0,0 +1,72 @@
+# Copyright 2022 Scheltema LAB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from chimerax.core.settings import Settings
+
+
+class _XMASSettings(Settings):
+
+    # Settings that are kept between ChimeraX sessions. They are stored in
+    # the XMAS settings file in the ChimeraX user config directory
+
+    AUTO_SAVE = {
+        # Maximum memory (in MB) used to remember peptide alignments between
+        # evidence files and mappings
+        "alignment_cache_size": 128,
+        # Number of processes used to align peptides to chains. With 1,
+        # alignment is performed in the ChimeraX process itself
+        "alignment_workers": 1,
+        # Approximate alignment: the number of mismatches allowed between a
+        # peptide and a chain sequence, and whether isoleucine and leucine
+        # are treated as equivalent
+        "alignment_mismatches": 0,
+        "alignment_il_equivalent": False,
+        # Number of peptide pairs that are passed at once through the stages
+        # of mapping
+        "evidence_chunk_size": 50000,
+        # Number of threads used to read evidence files while preceding 
+        # files are mapped. With 1, each file is read when it is mapped
+        "evidence_workers": 1,
+        # Peptide pairs with a lower score are disregarded while reading 
+        # XlinkX and Xi evidence files (None for no minimum)
+        "evidence_minimum_score": None,
+        # Whether parsed evidence files are stored in the user cache 
+        # directory, the maximum disk space (in MB) used to store them, and
+        # whether cached evidence files are identified by a hash of their 
+        # contents in addition to their path, size and modification time
+        "parse_cache_enabled": True,
+        "parse_cache_size": 512,
+        "parse_cache_content_hash": False,
+        # Whether .pb files are written gzip-compressed (as .pb.gz)
+        "pb_compression": False,
+        # Whether a columnar npz file is written next to each mapping 
+        # information file, for loading with info_file.load_info_file
+        "info_file_companion": False,
+        }
+
+
+_settings = None
+
+
+def get_settings(session):
+
+    # Return the XMAS settings, which are loaded on first use
+
+    global _settings
+
+    if _settings is None:
+        _settings = _XMASSettings(session, "XMAS")
+
+    return _settings
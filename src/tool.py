@@ -13,12 +13,18 @@
 # limitations under the License.
 
       
+from .chain_context import ChainContextCache
 from .info_file import InfoFile
 from .integrate import Integrate
 from .matplotlib_venn._venn2 import venn2
 from .matplotlib_venn._venn3 import venn3
-from .read_evidence import Evidence
-from chimerax.atomic.molarray import Pseudobonds
+from .parse_cache import get_parse_cache
+from .pb_writer import write_unique_lines
+from .peptide_index import (AlignmentCache, align_sequences, 
+                            count_mismatches)
+from .read_evidence import read_evidence_files
+from .settings import get_settings
+from chimerax.atomic.molarray import Atoms, Pseudobonds
 from chimerax.atomic.pbgroup import selected_pseudobonds, PseudobondGroup
 from chimerax.atomic.structure import Structure
 from chimerax.color_key.model import ColorKeyModel
@@ -29,6 +35,7 @@ from chimerax.core.selection import SELECTION_CHANGED
 from chimerax.core.tools import ToolInstance
 from chimerax.ui import MainToolWindow
 from chimerax.ui.widgets.color_button import MultiColorButton
+from concurrent.futures import ProcessPoolExecutor
 import matplotlib.pyplot as plt
 import numpy as np 
 import operator
@@ -46,6 +53,8 @@ from Qt.QtWidgets import (QVBoxLayout, QGridLayout, QHBoxLayout,
 from qtrangeslider import QRangeSlider
 import re
 import seaborn as sns
+from threading import Thread
+import traceback
 
 
 class XMAS(ToolInstance):
@@ -84,6 +93,19 @@ class XMAS(ToolInstance):
         # Call trigger handler to take action when certain triggers fire      
         self.trigger_handler()
         
+        # Cache of chain information used for alignment, which is kept up to
+        # date with triggers of its own
+        self.chain_contexts = ChainContextCache(session)
+        
+        # Worker processes for alignment, which are kept while mapping
+        self.alignment_executor = None
+        
+        # The mapping information file that was last created for each path.
+        # Distance updates in their delta files are merged into the files 
+        # upon closing. Files that have been rewritten by a later mapping 
+        # are not updated anymore
+        self.info_files = {}
+        
         # Override the "cleanup" method to perform additional actions 
         # upon closing the main tool window
         self.tool_window.cleanup = self.cleanup
@@ -243,6 +265,12 @@ class XMAS(ToolInstance):
         self.triggerset.remove_handler(self.change_selection_handler)
         self.triggerset.remove_handler(self.add_model_handler)
         self.triggerset.remove_handler(self.remove_model_handler)
+        self.chain_contexts.remove_handlers()
+        
+        for file in self.info_files.values():
+            if file.number_of_delta_rows > 0:
+                file.create_file()
+                print("Distances updated in %s" % file.path)
         
 
 
@@ -452,44 +480,142 @@ class XMAS(ToolInstance):
         # The user has selected one or multiple models and evidence
         # files, and clicked the map button: map crosslinked peptides
 
-        # Each checked file is mapped to all checked models
-        for j, evidence_file in enumerate(checked_files):
+        # The files are read in worker threads if allowed, while the 
+        # preceding files are being mapped. Files are mapped in order
+        settings = get_settings(self.session)
+        if settings.parse_cache_enabled:
+            parse_cache = get_parse_cache(self.session)
+        else:
+            parse_cache = None
+        evidence_files = read_evidence_files(
+            checked_files, settings.evidence_chunk_size, 
+            settings.evidence_workers, parse_cache, 
+            settings.evidence_minimum_score
+            )
+
+        # The alignment worker processes are started once for all chunks 
+        # and files. Processes are only started when they are used
+        if settings.alignment_workers > 1:
+            self.alignment_executor = ProcessPoolExecutor(
+                max_workers=settings.alignment_workers)
+
+        # Each checked file is mapped to all checked models. A file that 
+        # cannot be read or mapped does not prevent mapping of the others
+        try:
+            for evidence_file, evidence, error in evidence_files:
+                if error is None:
+                    try:
+                        self.map_evidence(evidence_file, evidence, 
+                                          checked_models)
+                        continue
+                    except Exception as mapping_error:
+                        error = mapping_error
+                # The traceback is logged as well, since the error may have
+                # been raised in a worker thread
+                self.session.logger.info("".join(traceback.format_exception(
+                    type(error), error, error.__traceback__)))
+                self.session.logger.error("Evidence file %s could not be "
+                                          "mapped: %s" 
+                                          % (evidence_file, error))
+        finally:
+            if self.alignment_executor is not None:
+                self.alignment_executor.shutdown()
+                self.alignment_executor = None
             
-            # Read the file and extract the peptide pairs and search engine 
-            # from it
-            evidence = Evidence(evidence_file)
-            input_pairs = evidence.peptide_pairs
-            engine = evidence.engine
-            if engine == "Xi_alternative":
-                log_engine = "Xi"
-            else:
-                log_engine = engine
-
-            # Display bold log message to signify which file is being
-            # mapped
-            self.session.logger.info(
-                "<br><b>Peptide pair mapping of %s evidence file: %s</b>" 
-                % (log_engine, evidence_file), is_html=True)
-                    
-            # Create a file for reference of the mapping results to the 
-            # evidence file
-            # Create a code for the model with the IDs of all models that the
-            # evidence file was mapped to
-            model_ids = ",".join([
-                str(model_id) for model_id in checked_models
-                ])
-            self.file_code = model_ids
-            info_file_path = (os.path.splitext(evidence_file)[0] 
-                              + "_%s.tsv" % self.file_code)
-            self.info_file = InfoFile(info_file_path, engine)
-
-            # Keep track of peptide pairs with lacking sequence
-            # information
-            sequence_info_lacking = 0
             
-            complete_input_pairs = []
+    def map_evidence(self, evidence_file, evidence, checked_models):
+        
+        # Map the peptide pairs of one evidence file to the checked 
+        # models
+        
+        settings = get_settings(self.session)
+        engine = evidence.engine
+        if engine == "Xi_alternative":
+            log_engine = "Xi"
+        else:
+            log_engine = engine
+
+        # Display bold log message to signify which file is being
+        # mapped
+        self.session.logger.info(
+            "<br><b>Peptide pair mapping of %s evidence file: %s</b>" 
+            % (log_engine, evidence_file), is_html=True)
+        if evidence.cached is not None:
+            print("Parsed evidence was read from the cache")
+                
+        # Create a file for reference of the mapping results to the 
+        # evidence file
+        # Create a code for the model with the IDs of all models that the
+        # evidence file was mapped to
+        model_ids = ",".join([
+            str(model_id) for model_id in checked_models
+            ])
+        self.file_code = model_ids
+        info_file_path = (os.path.splitext(evidence_file)[0] 
+                          + "_%s.tsv" % self.file_code)
+        self.info_file = InfoFile(info_file_path, engine,
+                                  settings.alignment_mismatches > 0,
+                                  settings.info_file_companion)
+        self.info_files[info_file_path] = self.info_file
+
+        # Mapping is performed in stages: filtering of peptide pairs with 
+        # lacking sequences, deduplication, alignment and finding of 
+        # pseudobonds. Peptide pairs are passed from stage to stage in 
+        # chunks, so that only a chunk and the unique peptide pairs need 
+        # to be kept in memory
+        chunk_size = settings.evidence_chunk_size
+        chunks = evidence.iter_chunks(chunk_size)
+        chunks = self.filter_incomplete(chunks, evidence)
+        peptide_pairs = self.deduplicate_chunks(chunks)
+        
+        if (settings.alignment_mismatches > 0 
+                or settings.alignment_il_equivalent):
+            print("Approximate alignment: up to %s mismatches, I/L %s"
+                  % (settings.alignment_mismatches, 
+                     "equivalent" if settings.alignment_il_equivalent 
+                     else "not equivalent"))
+        cache = self.get_alignment_cache()
+        cache.reset_counters()
+        
+        pbonds = []
+        # The number of perfectly aligned peptide pairs is counted
+        number_of_aligned_pairs = 0
+        
+        for start in range(0, len(peptide_pairs), chunk_size):
+            chunk = peptide_pairs[start:start + chunk_size]
+            self.align_peptides(chunk, checked_models)
+            number_of_aligned_pairs += self.find_pseudobonds(chunk, 
+                                                             pbonds)
+            
+        print("Alignment cache: %s hits, %s misses"
+              % (cache.hits, cache.misses))
+        
+        # Print a log message stating for how many peptide pairs perfect 
+        # alignments have been found
+        print("Unique peptide pairs with pseudobonds: %s" 
+            % number_of_aligned_pairs)
+        
+        self.create_files(pbonds, info_file_path)  
+    
+        # Print a log message stating where the mapping info is stored
+        print("Mapping information is stored in %s" % info_file_path)
+            
+            
+    def filter_incomplete(self, chunks, evidence):
+        
+        # Mapping stage that removes peptide pairs with lacking sequence
+        # information (including decoys) from chunks of peptide pairs. Most
+        # of these are already removed while reading the evidence file; 
+        # their references are added to the mapping information file when 
+        # all chunks have been read
 
-            for peptide_pair in input_pairs:
+        # Keep track of peptide pairs with lacking sequence
+        # information
+        sequence_info_lacking = 0
+        
+        for chunk in chunks:
+            complete_input_pairs = []
+            for peptide_pair in chunk:
                 if (peptide_pair.SequenceA == "" 
                         or peptide_pair.SequenceB == ""):
                     sequence_info_lacking += 1
@@ -497,108 +623,98 @@ class XMAS(ToolInstance):
                                        "Sequence lacking/decoy")
                     continue
                 complete_input_pairs.append(peptide_pair)
-                
-            # Print a message when one or multiple peptide pairs lack
-            # sequence information
-            if sequence_info_lacking == 1:
-                print("1 Peptide pair is disregarded due to lacking/decoy "
-                      "sequence")
-            elif sequence_info_lacking >= 1:
-                print("%s Peptide pairs are disregarded due to"
-                      % str(sequence_info_lacking),
-                      "lacking/decoy sequence")
+            yield complete_input_pairs
+            
+        for reason, refs in evidence.filtered_refs().items():
+            self.info_file.add_rows(refs, reason)
+            if reason == "Sequence lacking/decoy":
+                sequence_info_lacking += len(refs)
+            else:
+                print("%s Peptide pair(s) disregarded: %s" 
+                      % (len(refs), reason.lower()))
             
-            # Make sure that the highest score is taken in case of duplicates
-            self.duplicate_scores = {}
-            compare_function = self.advanced_equality_check
-            peptide_pairs = list(self.deduplicate(complete_input_pairs,
-                                                       compare_function))
-
-            # Print a message stating how many peptide pairs were unique
-            number_of_deduplicated = len(peptide_pairs)
-            print("Unique peptide pairs: %s out of %s" 
-                % (number_of_deduplicated, len(complete_input_pairs)))
-
-            for i in range(number_of_deduplicated):
-                peptide_pair = peptide_pairs[i]
-                ref = peptide_pair.Ref
-                if ref not in self.duplicate_scores.keys():
+        # Print a message when one or multiple peptide pairs lack
+        # sequence information
+        if sequence_info_lacking == 1:
+            print("1 Peptide pair is disregarded due to lacking/decoy "
+                  "sequence")
+        elif sequence_info_lacking >= 1:
+            print("%s Peptide pairs are disregarded due to"
+                  % str(sequence_info_lacking),
+                  "lacking/decoy sequence")
+            
+            
+    def deduplicate_chunks(self, chunks):
+        
+        # Mapping stage that combines chunks of peptide pairs into a list of
+        # unique peptide pairs. Peptide pairs are identical when their 
+        # sequences and crosslink positions are identical. In a single pass,
+        # the first of identical peptide pairs is kept, and receives the 
+        # highest score and the total CSM count of its duplicates. The 
+        # references of the duplicates are stored per reference of the 
+        # remaining peptide pair
+        
+        unique_pairs = {}
+        self.duplicate_refs = {}
+        number_of_complete = 0
+        
+        for chunk in chunks:
+            number_of_complete += len(chunk)
+            for peptide_pair in chunk:
+                key = (peptide_pair.SequenceA, peptide_pair.SequenceB,
+                       peptide_pair.XLinkPositionA, 
+                       peptide_pair.XLinkPositionB)
+                if key not in unique_pairs:
+                    unique_pairs[key] = peptide_pair
                     continue
-                scores = self.duplicate_scores[ref]
-                peptide_pair.Score = self.map_max_score(scores)
-     
-            self.align_peptides(peptide_pairs, checked_models)
- 
+                remaining = unique_pairs[key]
+                ref = remaining.Ref
+                if ref not in self.duplicate_refs:
+                    self.duplicate_refs[ref] = []
+                self.duplicate_refs[ref].append(peptide_pair.Ref)
+                self.info_file.add(peptide_pair.Ref, "Duplicate of %s" % ref)
+                remaining.Score = self.max_score(remaining.Score, 
+                                                 peptide_pair.Score)
+                remaining.NumCSMs += peptide_pair.NumCSMs
+                
+        peptide_pairs = list(unique_pairs.values())
+
+        # Print a message stating how many peptide pairs were unique
+        print("Unique peptide pairs: %s out of %s" 
+            % (len(peptide_pairs), number_of_complete))
+            
+        return peptide_pairs
     
-    def advanced_equality_check(self, item, last):
+    
+    def max_score(self, score1, score2):
         
-        # Compare sequences and crosslink positions of PeptidePair to determine 
-        # if they should be treated as equal
+        # Return the highest of two scores. If one of the peptide pairs has no
+        # score, the result has no score either. Scores are compared as 
+        # numbers, since they may have been read as text, and the original
+        # value is returned
         
-        is_equal = False
+        if score1 == "" or score2 == "":
+            return ""
         
-        # The first 'last' variable is an empty object. Hence, it has no 
-        # attributes
-        try:
-            last.SequenceA
-        except:
-            return False
+        if float(score2) > float(score1):
+            return score2
         
-        item_peptides = item.get_info() + item.get_info("XLinkPosition")
-        last_peptides = last.get_info() + last.get_info("XLinkPosition")
-        
-        # If they are identical, transfer reference and highest score to the
-        # remaining peptide pair
-        if item_peptides == last_peptides:
-            is_equal = True
-            ref = last.Ref
-            if ref not in self.duplicate_scores.keys():
-                self.duplicate_scores[ref] = [last.Score]
-            self.duplicate_scores[ref].append(item.Score)
-            self.info_file.add(item.Ref, "Duplicate of %s" % ref)
-            
-        return is_equal      
+        return score1
     
 
-    def deduplicate(self, lst, function):
-
-        # Remove duplicate items from a list
+    def get_alignment_cache(self):
         
-        # Simply compare list items...
-        if function == self.simple_equality_check:
-            lst.sort()
-        # ... or attributes of the list items
+        # Return the alignment cache, which is kept for the rest of the 
+        # session. Its maximum size is taken from the XMAS settings
+
+        max_size = get_settings(self.session).alignment_cache_size * 2**20
+
+        if not hasattr(self, "alignment_cache"):
+            self.alignment_cache = AlignmentCache(max_size)
         else:
-            lst.sort(key=operator.attrgetter("SequenceA", "SequenceB", 
-                                             "XLinkPositionA", 
-                                             "XLinkPositionB"))
-        last = object()
-        for item in lst:
-            if function(item, last):
-                continue
-            yield item
-            last = item
-            
-           
-    def simple_equality_check(self, item, last):
-        
-        return item == last
-            
-            
-    def map_max_score(self, scores):
-        
-        # Find the maximum score for each peptide pair
-        
-        max_score = 0
-        
-        for score in scores:
-            if score == "":
-                return ""
-            elif float(score) <= max_score:
-                continue
-            max_score = score
-            
-        return max_score
+            self.alignment_cache.max_size = max_size
+
+        return self.alignment_cache
     
             
     def align_peptides(self, peptide_pairs, checked_models):
@@ -621,81 +737,126 @@ class XMAS(ToolInstance):
         # NoneType, and ChimeraX does not enable creating
         # pseudobonds between NoneType residues. To prevent adding
         # these crosslinks to the .pb file, the positions of all
-        # NoneType residues is also stored in list 
-        # "nonetype_positions"
-
+        # NoneType residues are also stored, as well as the CA atom of
+        # each residue. This information is kept per chain in a
+        # ChainContext, which is cached between
+        # mappings until the structure changes
+        #
+        # Each chain sequence is scanned once for all peptides with a
+        # PeptideIndex (see align_sequences), optionally in multiple
+        # worker processes. The results are remembered in the alignment
+        # cache, so that peptides that were aligned before (e.g. from
+        # replicate evidence files or chains with the same sequence)
+        # do not need to be aligned again
+
+        # Store, for each peptide sequence, the peptide pairs and the letter
+        # of the peptide in the pair
+        letters = ["A", "B"]
+        peptide_occurrences = {}
+        for peptide_pair in peptide_pairs:
+            peptide_sequences = peptide_pair.get_info()
+            crosslink_positions = peptide_pair.get_info("XLinkPosition")
+            for i, peptide_sequence in enumerate(peptide_sequences):
+                if peptide_sequence not in peptide_occurrences:
+                    peptide_occurrences[peptide_sequence] = []
+                peptide_occurrences[peptide_sequence].append(
+                    (peptide_pair, letters[i], crosslink_positions[i]))
+        peptide_sequences = set(peptide_occurrences)
+        peptide_sequences.discard("")
+
+        chains = []
         for model in self.session.models:
             model_id = model.id_string
             if model_id not in checked_models:
                 continue
             for chain in model.chains:
-                # Keep track of the number of NoneType residues at
-                # the start of the sequence. These will influence
-                # the first residue number         
-                preceding_nonetypes = 0
-                first_residue_number_found = False
-                chain_sequence = chain.characters
-                nonetype_positions = []
-                residues = chain.residues
-                for i, residue in enumerate(residues):
-                    if (residue is None 
-                            and not first_residue_number_found):
-                        preceding_nonetypes += 1
-                        nonetype_positions.append(i)
-                    elif (residue is None 
-                            and first_residue_number_found):
-                        nonetype_positions.append(i)
-                    elif (residue is not None 
-                            and not first_residue_number_found):
-                        first_residue_number = (
-                            residue.number - preceding_nonetypes)
-                        first_residue_number_found = True
-                # Loop all peptide sequences over the chain to find
-                # perfect alignments
-                for peptide_pair in peptide_pairs:
-                    peptide_sequences = peptide_pair.get_info()
-                    crosslink_positions = peptide_pair.get_info("XLinkPosition")
-                    letters = ["A", "B"]
-                    for i, peptide_sequence in enumerate(peptide_sequences):
-                        peptide_length = len(peptide_sequence)
-                        for start in range(
-                                len(chain_sequence) - peptide_length + 1):
-                            end = start + peptide_length
-                            # If the crosslinked residue is not
-                            # present in the structure, the
-                            # pseudobond cannot be mapped, and
-                            # therefore we will disregard this
-                            # alignment                                
-                            crosslink_position = (
-                                start + crosslink_positions[i])
-                            if crosslink_position in nonetype_positions:
-                                continue
-                            if (chain_sequence[start:end] 
-                                    == peptide_sequence):
-                                alignment = Alignment(
-                                    start, end, first_residue_number, 
-                                    crosslink_position, model_id,
-                                    chain)
-                                alignments = getattr(peptide_pair, 
-                                                     "Alignments" 
-                                                     + letters[i])
-                                alignments.append(alignment)  
-                                
-        self.create_pseudobonds(peptide_pairs)
+                context = self.chain_contexts.get(model, chain)
+                # Chains without any residues in the structure cannot
+                # have pseudobonds
+                if context.first_residue_number is None:
+                    continue
+                chains.append((model_id, context))
+
+        # Optionally, peptides are aligned approximately, with mismatches
+        # and/or isoleucine and leucine being equivalent
+        settings = get_settings(self.session)
+        mismatches = settings.alignment_mismatches
+        il_equivalent = settings.alignment_il_equivalent
+        approximate = mismatches > 0 or il_equivalent
+
+        # Get the cached alignments for each unique chain sequence. 
+        # Alignments depend on the alignment mode, so this is part of the key
+        cache = self.get_alignment_cache()
+        sequence_hits = {}
+        sequence_missing = {}
+        for _, context in chains:
+            key = (context.sequence_key, mismatches, il_equivalent)
+            if key in sequence_hits:
+                continue
+            hits, missing = cache.lookup(key, peptide_sequences)
+            sequence_hits[key] = hits
+            if len(missing) > 0:
+                sequence_missing[key] = (context.sequence, missing)
+
+        # Scan the chain sequences for the peptides that were not cached,
+        # using a single index of all of these peptides. Only plain strings
+        # are passed, so that this can be done by multiple worker processes
+        if len(sequence_missing) > 0:
+            keys = list(sequence_missing)
+            all_missing = set()
+            for key in keys:
+                all_missing.update(sequence_missing[key][1])
+            all_hits = align_sequences(
+                all_missing, [sequence_missing[key][0] for key in keys],
+                settings.alignment_workers, mismatches, il_equivalent,
+                self.alignment_executor)
+            for key, hits in zip(keys, all_hits):
+                missing = sequence_missing[key][1]
+                cache.store(key, missing, hits)
+                for peptide_sequence in missing:
+                    if peptide_sequence in hits:
+                        sequence_hits[key][peptide_sequence] = (
+                            hits[peptide_sequence])
+
+        for model_id, context in chains:
+            hits = sequence_hits[(context.sequence_key, mismatches,
+                                  il_equivalent)]
+            for peptide_sequence in hits:
+                peptide_length = len(peptide_sequence)
+                starts = hits[peptide_sequence]
+                occurrences = peptide_occurrences[peptide_sequence]
+                for peptide_pair, letter, position in occurrences:
+                    for start in starts:
+                        end = start + peptide_length
+                        # If the crosslinked residue is not present
+                        # in the structure or has no CA atom, the
+                        # pseudobond cannot be mapped, and therefore
+                        # we will disregard this alignment
+                        crosslink_position = start + position
+                        if not context.has_ca(crosslink_position):
+                            continue
+                        alignment = Alignment(
+                            start, end, crosslink_position, model_id,
+                            context)
+                        if approximate:
+                            alignment.mismatches = count_mismatches(
+                                peptide_sequence, 
+                                context.sequence[start:end], il_equivalent)
+                        peptide_pair.add_alignment(letter, alignment)
 
             
-    def create_pseudobonds(self, peptide_pairs):
+    def find_pseudobonds(self, peptide_pairs, pbonds):
 
-        # Continue with creating all valid pseudobonds for all
-        # peptide pairs from the alignments and store them in a list. If both 
+        # Continue with finding all valid pseudobonds for all
+        # peptide pairs from the alignments and add them to a list. If both 
         # peptides of a pair are aligned on the same chain, these alignments
         # are checked for overlap. Make separate lists for peptide
         # pairs with non-overlapping peptides and those with
         # overlapping peptides. Overlapping peptides can be
-        # categorized as nonself-links and selflinks
+        # categorized as nonself-links and selflinks. Return the number of
+        # peptide pairs that have alignments for both peptides
 
         pbonds_unfiltered = []
-        pbonds = []
 
         # The number of perfectly aligned peptide pairs is counted
         number_of_aligned_pairs = 0
@@ -734,21 +895,14 @@ class XMAS(ToolInstance):
                     continue
                 elif (pb.is_overlapping and not pb.is_selflink):
                     self.info_file.add(ref, line, 
-                                       "Overlapping (non-self)")
+                                       "Overlapping (non-self)",
+                                       mismatches=pb.mismatches)
                 elif pb.is_selflink:  
                     self.info_file.add(ref, line, 
-                                       "Overlapping (self)")
+                                       "Overlapping (self)",
+                                       mismatches=pb.mismatches)
         
-        # Print a log message stating for how many peptide pairs perfect 
-        # alignments have been found
-        print("Unique peptide pairs with pseudobonds: %s" 
-            % number_of_aligned_pairs)
-        
-        info_file_path = self.info_file.path
-        self.create_files(pbonds, info_file_path)  
-
-        # Print a log message stating where the mapping info is stored
-        print("Mapping information is stored in %s" % info_file_path)
+        return number_of_aligned_pairs
         
         
     def create_files(self, pbonds, info_file_path):
@@ -772,11 +926,12 @@ class XMAS(ToolInstance):
             self.info_file.create_file()
             
                    
-    def create_pseudobonds_model(self, pbonds, file_path):
+    def create_pseudobonds_model(self, pbonds, file_path, operation="map"):
         
         # Called during mapping or exporting procedure
         # Create a new pb model from PrePseudobond (mapping) or Pseudobond 
-        # (exporting) object
+        # (exporting) object. Upon exporting, the model is created from the 
+        # pbs in memory, and the .pb file is written in the background
         
         # "file_path" is None when "create_pseudobonds_model" is called from 
         # the Export Dialog
@@ -788,8 +943,6 @@ class XMAS(ToolInstance):
             if file_path == "":
                 return
             operation = "export"
-        else:
-            operation = "map"
             
         name = self.get_short_filename(file_path)
         group = self.get_pseudobonds_model(name)
@@ -799,47 +952,55 @@ class XMAS(ToolInstance):
         # PrePseudobond or Pseudobond) and, therefore, the operation (mapping
         # or exporting, respectively)
         pbs_atoms_dict = self.pbs_atoms(pbonds, operation)
+        atom_pairs = list(pbs_atoms_dict.keys())
+        
+        # Upon mapping, keep the lowest number of mismatches of each peptide 
+        # pair per pb, to report in the info file
+        if operation == "map":
+            pb_mismatches = {}
+            for pb in pbonds:
+                key = (tuple(sorted([pb.atom1, pb.atom2])), pb.peptide_pair)
+                if (key in pb_mismatches 
+                        and pb_mismatches[key] <= pb.mismatches):
+                    continue
+                pb_mismatches[key] = pb.mismatches
+        
+        # Create all pbs at once
+        atoms1 = Atoms([atoms[0] for atoms in atom_pairs])
+        atoms2 = Atoms([atoms[1] for atoms in atom_pairs])
+        new_pbs, lines, distances = self.new_pseudobonds(group, atoms1, atoms2)
+        scores = [self.get_pseudobond_score(pbs_atoms_dict[atoms]) 
+                  for atoms in atom_pairs]
             
-        for atoms in list(pbs_atoms_dict.keys()):
-            new_pb = group.new_pseudobond(atoms[0], atoms[1])
-            line = new_pb.line = self.create_pb_line(new_pb)
+        for j, atoms in enumerate(atom_pairs):
+            new_pb = new_pbs[j]
+            line = new_pb.line = lines[j]
             peptide_pairs = new_pb.peptide_pairs = pbs_atoms_dict[atoms]
-            # Attach the info file to the pbs upon mapping
-            if operation == "map":
-                new_pb.info_file = self.info_file                    
-                new_pb.indices = [None] * len(peptide_pairs)
-                distance = new_pb.length
-            max_score = 0
-            has_peptide_pairs = False
-            has_score = True
+            # Attach a score to the new pb if applicable
+            if scores[j] is not None:
+                new_pb.score = scores[j]
+            if operation != "map":
+                continue
+            # Attach the info file to the pbs upon mapping, and append to the
+            # info file's dataframe
+            new_pb.info_file = self.info_file                    
+            new_pb.indices = [None] * len(peptide_pairs)
+            distance = distances[j]
             for i, peptide_pair in enumerate(peptide_pairs):
                 if peptide_pair is None:
                     continue
-                has_peptide_pairs = True
-                # Append to the info file's dataframe upon mapping
-                if operation == "map":
-                    if peptide_pair.has_overlapping:
-                        cat = "Overlap associated"
-                    else:
-                        cat = "Not overlap associated"
-                    index = self.info_file.add(peptide_pair.Ref, line, cat, 
-                                               distance)
-                    new_pb.indices[i] = index
-                # Attach a score to the new pb if applicable
-                score = peptide_pair.Score
-                if score == "":
-                    has_score = False
-                    break
-                elif score <= max_score:
-                    continue
-                max_score = score
-            if (has_score and has_peptide_pairs):
-                new_pb.score = max_score
-            elif (not has_score and has_peptide_pairs):
-                new_pb.score = ""
+                if peptide_pair.has_overlapping:
+                    cat = "Overlap associated"
+                else:
+                    cat = "Not overlap associated"
+                index = self.info_file.add(
+                    peptide_pair.Ref, line, cat, distance, 
+                    pb_mismatches[(atoms, peptide_pair)])
+                new_pb.indices[i] = index
   
-        self.write_file(file_path, group, file_type=".pb")
-        print("Pseudobonds are stored in %s" % file_path)
+        self.write_file(file_path, group, file_type=".pb", 
+                        asynchronous=(operation == "export"),
+                        message="Pseudobonds are stored in %s")
         
         if operation == "map":
             self.info_file.create_file()
@@ -851,6 +1012,45 @@ class XMAS(ToolInstance):
         return group.name
 
 
+    def new_pseudobonds(self, group, atoms1, atoms2):
+        
+        # Create pbs in a group between two aligned Atoms collections in one
+        # call. Return the new pbs, together with their lines for a .pb file 
+        # and their lengths
+        
+        new_pbs = group.new_pseudobonds(atoms1, atoms2)
+        lines = self.create_pb_lines(atoms1, atoms2)
+        distances = new_pbs.lengths.tolist()
+        
+        return new_pbs, lines, distances
+    
+    
+    def get_pseudobond_score(self, peptide_pairs):
+        
+        # Get the highest score of the peptide pairs of a pb. Return "" if 
+        # one of the peptide pairs has no score, and None if there are no 
+        # peptide pairs
+        
+        max_score = 0
+        has_peptide_pairs = False
+        
+        for peptide_pair in peptide_pairs:
+            if peptide_pair is None:
+                continue
+            has_peptide_pairs = True
+            score = peptide_pair.Score
+            if score == "":
+                return ""
+            elif score <= max_score:
+                continue
+            max_score = score
+            
+        if not has_peptide_pairs:
+            return None
+        
+        return max_score
+    
+
     def get_pseudobonds_model(self, name):
         
         # Create a new PseudobondGroup object in ChimeraX with the proper name
@@ -912,52 +1112,71 @@ class XMAS(ToolInstance):
         return atom_dict
 
 
-    def create_pb_line(self, pb):
+    def create_pb_lines(self, atoms1, atoms2):
         
-        # Create a line for a pb in a .pb file from the atoms that it connects
+        # Create lines in a .pb file for pbs between two aligned Atoms 
+        # collections. The atom strings are looked up in the cache of the 
+        # structures, after which the lines are made for all pbs at once. The
+        # atom strings of each line are sorted
+        
+        strings1 = self.chain_contexts.get_atom_strings(atoms1)
+        strings2 = self.chain_contexts.get_atom_strings(atoms2)
+        is_sorted = strings1 <= strings2
+        first = np.where(is_sorted, strings1, strings2)
+        second = np.where(is_sorted, strings2, strings1)
+        
+        return np.char.add(np.char.add(first, " "), second).tolist()
 
-        atom1, atom2 = pb.atoms
-        atom1_string = atom1.string(style="command line", omit_structure=False)
-        atom2_string = atom2.string(style="command line", omit_structure=False)
-        atoms_sorted = sorted([atom1_string, atom2_string])
-        pb_line = atoms_sorted[0] + " " + atoms_sorted[1]
 
-        return pb_line
-          
-
-    def write_file(self, file_path, group, file_type=".pb"):
+    def write_file(self, file_path, group, file_type=".pb", 
+                   asynchronous=False, message=None):
 
         # Write a file containing pb information (.pb or disvis restraints 
-        # .txt file)
+        # .txt file), and print the message, formatted with the path of the
+        # file, when it has been written. The lines are created first, so 
+        # that writing them can be done in a separate thread. .pb files are 
+        # compressed if this is set in the XMAS settings
 
         if file_type == ".pb":
-            pbs = group.pseudobonds
+            lines = [pb.line for pb in group.pseudobonds]
         else:
-            pbs = group
+            lines = list(group)
+            
+        if (file_path.endswith(".pb") 
+                and get_settings(self.session).pb_compression):
+            file_path += ".gz"
+
+        if asynchronous:
+            Thread(target=self.write_lines, 
+                   args=(file_path, lines, message, True),
+                   daemon=True).start()
+        else:
+            self.write_lines(file_path, lines, message)
 
-        lines = [None] * len(pbs)
-        if file_type == ".pb":
-            for i, pb in enumerate(pbs):
-                pb = pbs[i]
-                lines[i] = pb.line        
-        elif file_type == "export":
-            for i, pb in enumerate(pbs):
-                lines[i] = pb
+        return file_path
+    
+    
+    def write_lines(self, file_path, lines, message=None, 
+                    in_thread=False):
         
-        # File should not contain identical lines
-        lines_deduplicated = list(self.deduplicate(lines, 
-                                                   self.simple_equality_check))
-
-        created_file = open(file_path, "w")
-        for line in lines_deduplicated:
-            created_file.write(line + "\n")
-        created_file.close()
+        # Write lines to a file. Messages from a separate thread are passed
+        # to the main thread to be logged
         
-        if (file_type == "export" and file_path[-3:] == ".pb"):
-            text = "open \"%s\"" % file_path
-            run(self.session, text, log = False)
-
-        return len(lines_deduplicated)
+        if in_thread:
+            log = self.session.ui.thread_safe
+        else:
+            log = lambda function, *args: function(*args)
+        
+        try:
+            report = write_unique_lines(file_path, lines)
+        except OSError as error:
+            log(self.session.logger.error, 
+                "%s could not be written: %s" % (file_path, error))
+            return
+        
+        if message is not None:
+            log(print, message % file_path)
+        log(print, report.throughput())
 
 
     def check_signal(self, item, column):
@@ -1209,23 +1428,38 @@ class XMAS(ToolInstance):
         
         # Update the distances in the mapping information file
         
+        # Only the rows of which the distance has changed are written, to 
+        # the delta file of each mapping information file
+        
         for model in pbs_dict:
             pbs = pbs_dict[model]
-            files = set()
+            file_distances = {}
             for pb in pbs:
                 try:
                     file = pb.info_file
                 except:
                     continue
-                file = pb.info_file
-                files.add(file)
+                if file not in file_distances:
+                    file_distances[file] = {}
+                distances = file_distances[file]
                 distance = pb.length
-                indices = pb.indices
-                for index in indices:
-                    file.df.at[index, "Distance (A)"] = distance
-            for file in files:
-                file.create_file()
-                print("Distances updated in %s" % file.path)
+                for index in pb.indices:
+                    if index is not None:
+                        distances[index] = distance
+            for file, distances in file_distances.items():
+                if self.info_files.get(file.path) is not file:
+                    print("Distances are not updated in %s, since it has "
+                          "been rewritten by a later mapping" % file.path)
+                    continue
+                changed = file.update_distances(distances)
+                if file.number_of_delta_rows == 0:
+                    print("Distances updated in %s (%s changed)" 
+                          % (file.path, changed))
+                    continue
+                # The delta file is merged into the mapping information file
+                # when XMAS is closed, if not before
+                print("Distances updated in %s (%s changed), to be merged "
+                      "into %s" % (file.delta_path, changed, file.path))
  
 
     def get_names(self, treewidget, pbs_dict, function):
@@ -1509,25 +1743,19 @@ class XMAS(ToolInstance):
         # Determine which files need to be created, and create them. Show 
         # DisVis dialog if DisVis restraints file needs to be created
         if checkboxes["Pb"].isChecked():
-            pb_lines = []
-            for pb in valid_pseudobonds:
-                if hasattr(pb, "line"):
-                    pb_line = pb.line
-                else:
-                    pb_line = self.create_pb_line(pb)
-                pb_lines.append(pb_line)
+            # The lines of the .pb file are created with the pb model
             if not checkboxes["DisVis"].isChecked():
                 self.create_pseudobonds_model(valid_pseudobonds, None)
                 self.subset_dialog.destroy()
             else:
-                self.show_disvis_dialog(models, valid_pseudobonds, pb_lines)
+                self.show_disvis_dialog(models, valid_pseudobonds, True)
 
         elif (not checkboxes["Pb"].isChecked()
               and checkboxes["DisVis"].isChecked()):
             self.show_disvis_dialog(models, valid_pseudobonds)
 
 
-    def show_disvis_dialog(self, models, pseudobonds, pb_lines=None):
+    def show_disvis_dialog(self, models, pseudobonds, write_pb=False):
         
         # Dialog to specify fixed and scanning chain, and minimum and maximum
         # distance for DisVis restraints file
@@ -1586,7 +1814,7 @@ class XMAS(ToolInstance):
             for i, distance in enumerate(distance_options):
                 value = line_edits[i]
                 distances[distance] = value               
-            self.create_disvis_input(chains, distances, pseudobonds, pb_lines)
+            self.create_disvis_input(chains, distances, pseudobonds, write_pb)
             self.subset_dialog.destroy()
 
         ok_cancel = QDialogButtonBox(QDialogButtonBox.Ok 
@@ -1603,9 +1831,10 @@ class XMAS(ToolInstance):
 
 
     def create_disvis_input(self, chains, distances, pseudobonds,
-                            pb_lines=None):
+                            write_pb=False):
         
-        # Create a DisVis restraints file for a set of pbs
+        # Create a DisVis restraints file for a set of pbs, and optionally a
+        # .pb file
 
         minimum = distances["Minimum"].text()
         maximum = distances["Maximum"].text()
@@ -1664,21 +1893,23 @@ class XMAS(ToolInstance):
             print("No pseudobonds match the criteria")
             return
         
-        if pb_lines is not None:
+        if write_pb:
             title = "Save pseudobonds and DisVis input"
             extension = "*.pb *.txt"
         else:
             title = "Save DisVis input"
             extension = "*.txt"
+            pseudobonds = None
             
-        self.save_subset(title, extension, [pb_lines, lines])
+        self.save_subset(title, extension, lines, pseudobonds)
 
         self.disvis_dialog.destroy()
             
 
-    def save_subset(self, title, extension, lists):
+    def save_subset(self, title, extension, lines, pseudobonds=None):
         
-        # Save a subset of pbs in .pb and/or DisVis restraints .txt file
+        # Save a subset of pbs in a DisVis restraints .txt file. If the pbs 
+        # are given, a pb model is created from them for a .pb file as well
 
         file_path, _ = QFileDialog.getSaveFileName(None, title, 
                                                    "", extension)
@@ -1687,13 +1918,11 @@ class XMAS(ToolInstance):
             return
 
         file_path = os.path.splitext(file_path)[0]
-        extensions = [".pb", ".txt"]
 
-        for i, lst in enumerate(lists):
-            if lst is None:
-                continue
-            current_path = file_path + extensions[i]
-            self.write_file(current_path, lst, file_type="export")
+        if pseudobonds is not None:
+            self.create_pseudobonds_model(pseudobonds, file_path + ".pb", 
+                                          "export")
+        self.write_file(file_path + ".txt", lines, file_type="export")
             
 
     def display_all(self, pseudobonds):
@@ -2160,25 +2389,28 @@ class XMAS(ToolInstance):
 
 class Alignment:
     
+    # Slots are used instead of a dictionary per instance, since many
+    # alignments can be found for an evidence file
+    __slots__ = ["start_position", "end_position", "crosslink_position", 
+                 "atom", "mismatches", "id_string"]
+    
 
-    def __init__(
-        self, start, end, first_residue_number, crosslink_position, model_id,
-        chain):
+    def __init__(self, start, end, crosslink_position, model_id, context):
 
         # Start and end position indicate the range of positions in the
-        # sequence that is spanned by the peptide        
+        # sequence that is spanned by the peptide
+        first_residue_number = context.first_residue_number
         self.start_position = start + first_residue_number
         self.end_position = end + first_residue_number
         # Position of the crosslinked residue in the sequence        
         self.crosslink_position = crosslink_position + first_residue_number
-        residue = chain.residues[crosslink_position]
-        atoms = residue.atoms
-        for atom in atoms:
-            if atom.name == "CA":
-                self.atom = atom
+        self.atom = context.ca_atom(crosslink_position)
+        # Number of mismatches between the peptide and the chain sequence
+        # (only with approximate alignment)
+        self.mismatches = 0
         # String indicating on which model and chain the alignment was
         # found
-        self.id_string = "#" + model_id + "/" + chain.chain_id
+        self.id_string = "#" + model_id + "/" + context.chain_id
 
 
 class PrePseudobond:
@@ -2186,6 +2418,10 @@ class PrePseudobond:
     # To avoid clashes with ChimeraX's Pseudobond class, this class is
     # named PrePseudobond    
     
+    __slots__ = ["pos1", "pos2", "id1", "id2", "atom1", "atom2", 
+                 "peptide_pair", "score", "mismatches", "line", 
+                 "is_overlapping", "is_selflink"]
+    
     def __init__(self, alignment1, alignment2, peptide_pair):
 
         # The crosslink positions of the two alignments dictate
@@ -2198,6 +2434,7 @@ class PrePseudobond:
         self.atom2 = alignment2.atom        
         self.peptide_pair = peptide_pair
         self.score = peptide_pair.Score
+        self.mismatches = alignment1.mismatches + alignment2.mismatches
         # A string is created that will be one line in a .pb file
         self.line = self.create_pb_line()
         # Check for overlap between the two alignments
@@ -313,7 +313,8 @@ class ZScoreSelector:
     def create_pb_file(self):
         
         # The user has clicked OK; pseudobonds that are within the specified
-        # z-score range are written in a new .pb file.
+        # z-score range are written in a new .pb file, and a model is created
+        # from them.
         
         if not hasattr(self, "pbs"):
             return
@@ -328,8 +329,7 @@ class ZScoreSelector:
         for pb in self.pbs:
             if pb.outside_range:
                 continue
-            pb_line = self.xmas.create_pb_line(pb)
-            chosen_restraints.append(pb_line)
+            chosen_restraints.append(pb)
             
         if len(chosen_restraints) == 0:
             print("No restraints found for this z-score range")
@@ -342,8 +342,8 @@ class ZScoreSelector:
             
         file_path = path + self.name.replace(".pb", "_selected.pb")
         
-        self.xmas.write_file(file_path, chosen_restraints, "export")
-        print("Selected restraints saved in %s" % file_path)
+        self.xmas.create_pseudobonds_model(chosen_restraints, file_path, 
+                                           "export")
         
         
     def cleanup(self):